@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""Time until the device is ready again after a transfer is cancelled.
+
+A GET_OBJECT from a slow disk with read-ahead and a SEND_OBJECT to a
+stalling disk with write-behind are each started and then cancelled
+part way through, the way the responder cancels them when a Cancel
+Request arrives on ep0. Reported is the time from the cancel until the
+data stage has stopped and the endpoints have been cleared out, and
+how long the rest of the transfer would have kept the device busy.
+
+The last case runs a whole responder: a GET_OBJECT small enough that
+every buffer of it is queued at once goes to a host which has stopped
+reading, and the Cancel Request arrives while the response is waiting
+for a free buffer. Reported is the time from the request until the
+device status is OK again.
+"""
+
+import os, sys, time, asyncio, argparse, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.responder import MTPResponder
+from mtp.packets import MTPData, OperationStruct, OperationCode, OPERATION, indata, outdata
+from benchmarks.endpoints import PacedINEndpoint, PacedOUTEndpoint, MemoryOUTEndpoint, MemoryINTEndpoint
+from benchmarks.readahead import ThrottledFile
+from benchmarks.writebehind import StallingFile
+
+
+async def cancel(ep, coro, after):
+    task = asyncio.get_event_loop().create_task(coro)
+    await asyncio.sleep(after)
+    t = time.perf_counter()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    await ep.abort()
+    return time.perf_counter() - t
+
+
+def get_object(path, args):
+    ep = PacedINEndpoint(rate=args.usb * 1e6)
+    ep.readahead = (0x100000, 4)
+    f = ThrottledFile(path, 0.001, args.disk * 1e6)
+    t = asyncio.run(cancel(ep, indata(ep, OperationCode.encmapping['GET_OBJECT'], 1, f), args.after / 1000))
+    f.close()
+    return t, ((args.size << 20) - ep.sent) / (args.usb * 1e6)
+
+
+def send_object(path, args):
+    ep = PacedOUTEndpoint(path, rate=args.usb * 1e6)
+    ep.writebehind = 0x800000
+    f = StallingFile(args.disk * 1e6, 4 << 20, 0.03)
+    t = asyncio.run(cancel(ep, outdata(ep, OperationCode.encmapping['SEND_OBJECT'], 1, f), args.after / 1000))
+    ep.close()
+    return t, ((args.size << 20) - f.written) / (args.disk * 1e6)
+
+
+async def poll(responder, inep, after):
+    """Send a Cancel Request after a while, then poll the device status.
+
+    The time is counted from when the request arrived, so it includes
+    any time the event loop was too busy to notice it.
+    """
+    t = time.perf_counter() + after
+    await asyncio.sleep(after)
+    remaining = max(inep.done, default=t) - t
+    responder.cancel()
+    while responder.status() != 'OK':
+        await asyncio.sleep(0.0005)
+    return time.perf_counter() - t, max(0, remaining)
+
+
+def queued(path, args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    outep = MemoryOUTEndpoint()
+    # The host reads so slowly that it might as well have stopped.
+    inep = PacedINEndpoint(rate=1e5)
+    intep = MemoryINTEndpoint()
+    with tempfile.TemporaryDirectory() as root:
+        with open(os.path.join(root, 'object'), 'wb') as f:
+            f.write(bytes(inep.nr_requests * inep.bufsize - 0x100))
+        options = argparse.Namespace(
+            name='Benchmark', storage=[('Files', root)], index=None, lazy=False, compact=False,
+            prestat=False, scan_workers=1, watch_budget=None,
+        )
+        responder = MTPResponder(outep, inep, intep, loop, options)
+        handle = next(iter(responder.sm.handles(0xffffffff, 0xffffffff)))
+        for tx_id, code, p1 in ((1, 'OPEN_SESSION', 1), (2, 'GET_OBJECT', handle)):
+            outep.push(OperationStruct.pack(OperationStruct.size, OPERATION, OperationCode.encmapping[code], tx_id, p1, 0, 0, 0, 0))
+        t, remaining = loop.run_until_complete(poll(responder, inep, args.after / 1000))
+        loop.close()
+    outep.close()
+    intep.close()
+    return t, remaining
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cancel benchmark.')
+    parser.add_argument('--size', type=int, help='Object size in MiB.', default=256)
+    parser.add_argument('--usb', type=float, help='Endpoint speed in MB/s.', default=40)
+    parser.add_argument('--disk', type=float, help='Disk speed in MB/s.', default=20)
+    parser.add_argument('--after', type=float, help='Time to cancel after in ms.', default=500)
+    args = parser.parse_args()
+
+    length = args.size << 20
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(MTPData.build(dict(length=length + 12, code='SEND_OBJECT', tx_id=1)))
+        f.write(bytes(length))
+        f.flush()
+        print('%-20s %14s %16s' % ('operation', 'ready ms', 'remaining ms'))
+        for name, fn in (('GET_OBJECT', get_object), ('SEND_OBJECT', send_object), ('GET_OBJECT queued', queued)):
+            t, remaining = fn(f.name, args)
+            print('%-20s %14.1f %16.1f' % (name, t * 1000, remaining * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""Fake endpoints for running the data path without functionfs."""
+
+import os
+import mmap
+import time
+import struct
+import asyncio
+import collections
+
+from mtp.packets import RESPONSE, ResponseStruct, Operation
+
+
+class FileOUTEndpoint(object):
+
+    """Replays a bulk-OUT stream from a file.
+
+    Reads complete the way the UDC completes them for KAIOReader: a
+    full buffer, or whatever is left of the transfer. The file holds a
+    single transfer, so EOF behaves like the ZLP that ends it.
+    """
+
+    def __init__(self, path, bufsize=0x10000):
+        self.file = open(path, 'rb', buffering=0)
+        self.bufsize = bufsize
+        self.writebehind = 0
+        self.writepool = []
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+
+    def ready(self):
+        return True
+
+    def readview(self):
+        n = self.file.readinto(self.view)
+        return self.view if n == self.bufsize else self.view[:n]
+
+    def release(self):
+        pass
+
+    def read(self):
+        return bytearray(self.readview())
+
+    async def abort(self):
+        pass
+
+    def close(self):
+        self.file.close()
+
+
+class CopyingOUTEndpoint(FileOUTEndpoint):
+
+    """Like FileOUTEndpoint, but returns a new copy of every buffer."""
+
+    def readview(self):
+        return self.read()
+
+    def read(self):
+        return bytearray(super().readview())
+
+
+class PacedOUTEndpoint(FileOUTEndpoint):
+
+    """Like FileOUTEndpoint, but buffers arrive at rate bytes per second.
+
+    With blocking set, ready() is always True and readview() sleeps
+    until the buffer arrives, the way the data stage used to wait.
+    Otherwise the wait is done in wait_async(). late is the longest
+    time a buffer waited to be read.
+    """
+
+    def __init__(self, path, bufsize=0x10000, rate=40e6, blocking=False):
+        super().__init__(path, bufsize)
+        self.interval = bufsize / rate
+        self.blocking = blocking
+        self.due = time.perf_counter() + self.interval
+        self.late = 0
+
+    def ready(self):
+        return self.blocking or time.perf_counter() >= self.due
+
+    async def wait_async(self):
+        await asyncio.sleep(max(0, self.due - time.perf_counter()))
+
+    def readview(self):
+        delay = self.due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.late = max(self.late, -delay)
+        self.due = max(self.due, time.perf_counter() - self.interval) + self.interval
+        return super().readview()
+
+
+class PacedINEndpoint(object):
+
+    """A bulk-IN endpoint which sends at rate bytes per second.
+
+    Like KAIOBulkWriter, up to nr_requests buffers can be queued and
+    ready() is False while they are all waiting to be sent.
+    """
+
+    def __init__(self, nr_requests=4, bufsize=0x10000, rate=40e6):
+        self.bufsize = bufsize
+        self.maxpkt = 512
+        self.zerocopy = False
+        self.readahead = None
+        self.readpool = []
+        self.rate = rate
+        self.nr_requests = nr_requests
+        self.done = []
+        self.buf = bytearray(bufsize)
+        self.sent = 0
+
+    def collect(self):
+        now = time.perf_counter()
+        self.done = [t for t in self.done if t > now]
+
+    def ready(self):
+        self.collect()
+        return len(self.done) < self.nr_requests
+
+    def free(self):
+        self.collect()
+        return self.nr_requests - len(self.done)
+
+    async def wait_async(self):
+        await asyncio.sleep(max(0, min(self.done) - time.perf_counter()))
+
+    def buffer(self):
+        while not self.ready():
+            time.sleep(max(0, min(self.done) - time.perf_counter()))
+        return 0, memoryview(self.buf)
+
+    def submit(self, slot, length, buf=None):
+        start = max(self.done, default=time.perf_counter())
+        self.done.append(max(start, time.perf_counter()) + length / self.rate)
+        self.sent += length
+
+    def write(self, buf):
+        self.buffer()
+        self.submit(0, len(buf))
+
+    def unmap(self):
+        pass
+
+    async def abort(self):
+        self.done.clear()
+
+
+class MemoryOUTEndpoint(object):
+
+    """A bulk-OUT endpoint fed by a host in the same process.
+
+    push() queues a transfer, which is cut into buffers the way
+    KAIOReader returns them: full buffers, then the tail, or a ZLP if
+    the transfer filled the last buffer exactly. fileno() is readable
+    while there are buffers waiting, so the responder can watch it.
+    """
+
+    def __init__(self, bufsize=0x10000):
+        self.bufsize = bufsize
+        self.writebehind = 0
+        self.writepool = []
+        self.buffers = collections.deque()
+        self.arrived = asyncio.Event()
+        self.r, self.w = os.pipe()
+
+    def fileno(self):
+        return self.r
+
+    def push(self, transfer):
+        if not self.buffers:
+            os.write(self.w, b'\0')
+        view = memoryview(transfer)
+        for n in range(0, len(view), self.bufsize):
+            self.buffers.append(view[n:n+self.bufsize])
+        if len(view) % self.bufsize == 0:
+            self.buffers.append(view[:0])
+        self.arrived.set()
+
+    def ready(self):
+        return bool(self.buffers)
+
+    async def wait_async(self):
+        self.arrived.clear()
+        await self.arrived.wait()
+
+    def readview(self):
+        buf = self.buffers.popleft()
+        if not self.buffers:
+            os.read(self.r, 1)
+        return buf
+
+    def release(self):
+        pass
+
+    def read(self):
+        return bytearray(self.readview())
+
+    def submit(self):
+        pass
+
+    async def abort(self):
+        while self.buffers:
+            self.readview()
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
+class MemoryINEndpoint(object):
+
+    """A bulk-IN endpoint read by a host in the same process.
+
+    Every write completes at once. The containers are reassembled from
+    the transfers: the payload of a data container is kept, up to keep
+    bytes, and counted, and response is a future which is given the
+    response container, unpacked like an operation, with the data
+    that came before it. Responses which arrive when none is expected
+    are counted in stray. With zerocopy set, sendfile() hands the
+    requests views of a mapping of the file, like KAIOBulkWriter.
+    """
+
+    def __init__(self, bufsize=0x10000, keep=0x100000, zerocopy=False):
+        self.bufsize = bufsize
+        self.maxpkt = 512
+        self.zerocopy = zerocopy
+        self.readahead = None
+        self.readpool = []
+        self.keep = keep
+        self.buf = bytearray(bufsize)
+        self.remaining = 0
+        self.data = bytearray()
+        self.received = 0
+        self.response = None
+        self.stray = 0
+
+    def expect(self):
+        """Start a transaction. Returns the future for its response."""
+        self.data = bytearray()
+        self.received = 0
+        self.response = asyncio.get_event_loop().create_future()
+        return self.response
+
+    def ready(self):
+        return True
+
+    def free(self):
+        return 1
+
+    def buffer(self):
+        return 0, memoryview(self.buf)
+
+    def submit(self, slot, length, buf=None):
+        view = memoryview(self.buf if buf is None else buf)[:length]
+        if not view:
+            return # ZLP
+        if self.remaining == 0:
+            length, type = struct.unpack_from('<IH', view)
+            if type == RESPONSE:
+                if self.response is None or self.response.done():
+                    self.stray += 1
+                    return
+                self.response.set_result((Operation._make(ResponseStruct.unpack_from(view)), self.data))
+                return
+            self.remaining = length - 12
+            view = view[12:]
+        self.remaining -= len(view)
+        self.received += len(view)
+        if len(self.data) < self.keep:
+            self.data += view
+
+    def write(self, buf):
+        self.buf[:len(buf)] = buf
+        self.submit(0, len(buf))
+
+    def sendfile(self, fd, offset, length):
+        view = memoryview(mmap.mmap(fd, 0, access=mmap.ACCESS_READ))
+        length = max(0, min(length, len(view) - offset))
+        for n in range(offset, offset + length, self.bufsize):
+            self.submit(0, min(self.bufsize, offset + length - n), view[n:])
+        return length
+
+    def unmap(self):
+        pass
+
+    async def abort(self):
+        self.remaining = 0
+
+
+class MemoryINTEndpoint(object):
+
+    """An interrupt endpoint which counts the events sent to it."""
+
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        self.events = 0
+
+    def fileno(self):
+        return self.r
+
+    def ready(self):
+        return True
+
+    def write(self, buf):
+        self.events += 1
+        return True
+
+    def pump(self):
+        return 1
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
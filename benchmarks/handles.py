@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""Handle table churn.
+
+A table is filled with live objects, then objects are repeatedly
+unregistered and replaced by new ones, as happens on a device which
+rotates its camera roll or logs. Every cycle also looks up the handle
+which was just freed, which must fail, and a live handle, which must
+succeed. Memory per live entry is measured with tracemalloc.
+"""
+
+import os, sys, time, random, argparse, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.exceptions import MTPError
+from mtp.handlemanager import HandleManager
+
+
+class Obj(object):
+    __slots__ = ('handle', )
+
+
+def churn(hm, live, cycles):
+    objs = [Obj() for i in range(live)]
+    for o in objs:
+        hm.register(o)
+    rng = random.Random(0)
+    stale = 0
+    highest = 0
+    t = time.perf_counter()
+    for i in range(cycles):
+        n = rng.randrange(live)
+        old = objs[n]
+        handle = old.handle
+        hm.unregister(old)
+        new = Obj()
+        objs[n] = new
+        hm.register(new)
+        highest = max(highest, new.handle)
+        try:
+            hm[handle]
+        except MTPError:
+            stale += 1
+        hm[objs[rng.randrange(live)].handle]
+    t = time.perf_counter() - t
+    return t, stale, highest
+
+
+def footprint(live):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    hm = HandleManager()
+    objs = [Obj() for i in range(live)]
+    middle, _ = tracemalloc.get_traced_memory()
+    for o in objs:
+        hm.register(o)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (after - middle) / live
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Handle table churn benchmark.')
+    parser.add_argument('--live', type=int, help='Number of live objects.', default=100000)
+    parser.add_argument('--cycles', type=int, help='Number of unregister/register cycles.', default=2000000)
+    args = parser.parse_args()
+
+    t, stale, highest = churn(HandleManager(), args.live, args.cycles)
+    print('%d cycles with %d live objects: %.0f cycles/s' % (args.cycles, args.live, args.cycles / t))
+    print('stale handles rejected: %d/%d' % (stale, args.cycles))
+    print('highest handle: 0x%08x' % (highest, ))
+    print('bytes per registered object, including its handle: %.1f' % (footprint(args.live), ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+"""Start up scan time with a pool of indexer processes.
+
+Two storages are created in a temporary directory and loaded as the
+responder does at start up, serially and then with the Indexer using
+2 and 4 worker processes. Each is timed with a warm page cache and,
+when run as root, with a cold one.
+"""
+
+import os, sys, time, argparse, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.handlemanager import HandleManager
+from mtp.storage import StorageManager, FilesystemStorage
+from mtp.indexer import Indexer
+from benchmarks.tree import NullWatchManager, make_tree
+from benchmarks.scan import drop_caches
+
+
+def load(paths, workers, prestat):
+    hm = HandleManager()
+    sm = StorageManager(hm)
+    if workers > 1:
+        indexer = Indexer(workers)
+        listings = [indexer.scan(path, prestat) for path in paths]
+    else:
+        listings = [None] * len(paths)
+    for n, (path, l) in enumerate(zip(paths, listings)):
+        FilesystemStorage('Storage %d' % (n, ), path, sm, hm, NullWatchManager(), prestat=prestat, listings=l)
+    if workers > 1:
+        indexer.close()
+    return sum(1 for h in hm.handles())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parallel indexer benchmark.')
+    parser.add_argument('--files', type=int, help='Number of files to create in each storage.', default=100000)
+    parser.add_argument('--per-dir', type=int, help='Files per directory.', default=200)
+    parser.add_argument('--stat-on-scan', action='store_true', dest='prestat', help='Stat every object while scanning.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        paths = [os.path.join(path, 'sd'), os.path.join(path, 'ssd')]
+        for p in paths:
+            os.mkdir(p)
+            make_tree(p, args.files, args.per_dir)
+        print('%d CPUs' % (os.cpu_count(), ))
+        print('%-8s %-6s %10s %10s' % ('workers', 'cache', 'objects', 'seconds'))
+        for workers in (1, 2, 4):
+            for cache in ('cold', 'warm'):
+                if cache == 'cold' and not drop_caches():
+                    continue
+                t = time.perf_counter()
+                n = load(paths, workers, args.prestat)
+                t = time.perf_counter() - t
+                print('%-8d %-6s %10d %10.2f' % (workers, cache, n, t))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""Event loop latency during a large SEND_OBJECT.
+
+A data stage is replayed through outdata() from a fake endpoint which
+delivers buffers at USB 2.0 speed, as a task in an event loop which
+also runs a callback every few milliseconds, standing in for inotify
+dispatch and interrupt endpoint events. How late that callback runs
+is reported with the endpoint waits blocking the loop, which is how
+the data stage used to run, and with them awaited.
+"""
+
+import os, sys, time, asyncio, argparse, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.packets import MTPData, OperationCode, outdata
+from benchmarks.endpoints import PacedOUTEndpoint
+
+
+def run(path, rate, blocking, period):
+    loop = asyncio.new_event_loop()
+    late = []
+
+    def tick(due):
+        now = time.perf_counter()
+        late.append(now - due)
+        handle[0] = loop.call_later(period, tick, now + period)
+
+    ep = PacedOUTEndpoint(path, rate=rate, blocking=blocking)
+    dest = open('/dev/null', 'wb')
+    handle = [loop.call_later(period, tick, time.perf_counter() + period)]
+    t = time.perf_counter()
+    loop.run_until_complete(outdata(ep, OperationCode.encmapping['SEND_OBJECT'], 1, dest))
+    t = time.perf_counter() - t
+    handle[0].cancel()
+    loop.close()
+    ep.close()
+    dest.close()
+    return t, late
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Event latency during a transfer.')
+    parser.add_argument('--size', type=int, help='Object size in MiB.', default=64)
+    parser.add_argument('--rate', type=float, help='Endpoint speed in MB/s.', default=40)
+    parser.add_argument('--period', type=float, help='Interval of the event callback in ms.', default=5)
+    args = parser.parse_args()
+
+    length = args.size << 20
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(MTPData.build(dict(length=length + 12, code='SEND_OBJECT', tx_id=1)))
+        f.write(bytes(length))
+        f.flush()
+
+        print('%-10s %10s %8s %14s %14s' % ('data stage', 'seconds', 'events', 'mean late ms', 'max late ms'))
+        for name, blocking in (('blocking', True), ('async', False)):
+            t, late = run(f.name, args.rate * 1e6, blocking, args.period / 1000)
+            mean = sum(late) / len(late) if late else t
+            print('%-10s %10.2f %8d %14.2f %14.2f' % (name, t, len(late), mean * 1000, max(late, default=t) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""GET_OBJECT throughput from a slow disk, with and without read-ahead.
+
+A file is sent through indata() to a fake endpoint which drains at USB
+2.0 speed. Reads from the file are throttled to look like an SD card:
+each read costs a fixed latency plus its size over the card's speed.
+Without read-ahead each endpoint buffer is read in the event loop;
+with it a worker thread reads large buffers ahead of the endpoint.
+"""
+
+import os, sys, time, asyncio, argparse, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.packets import OperationCode, indata
+from benchmarks.endpoints import PacedINEndpoint
+
+
+class ThrottledFile(object):
+
+    def __init__(self, path, latency, rate):
+        self.file = open(path, 'rb', buffering=0)
+        self.latency = latency
+        self.rate = rate
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def seek(self, offset, whence):
+        return self.file.seek(offset, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def readinto(self, buf):
+        n = self.file.readinto(buf)
+        time.sleep(self.latency + n / self.rate)
+        return n
+
+    def close(self):
+        self.file.close()
+
+
+def run(path, args, readahead):
+    ep = PacedINEndpoint(rate=args.usb * 1e6)
+    ep.readahead = readahead
+    f = ThrottledFile(path, args.latency / 1000, args.disk * 1e6)
+    t = time.perf_counter()
+    asyncio.run(indata(ep, OperationCode.encmapping['GET_OBJECT'], 1, f))
+    while not ep.free() == ep.nr_requests:
+        time.sleep(0.001)
+    t = time.perf_counter() - t
+    f.close()
+    return ep.sent / t / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Read-ahead benchmark.')
+    parser.add_argument('--size', type=int, help='Object size in MiB.', default=32)
+    parser.add_argument('--usb', type=float, help='Endpoint speed in MB/s.', default=40)
+    parser.add_argument('--disk', type=float, help='Disk speed in MB/s.', default=80)
+    parser.add_argument('--latency', type=float, help='Disk latency per read in ms.', default=1)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(bytes(args.size << 20))
+        f.flush()
+        print('%-20s %10s' % ('read-ahead', 'MB/s'))
+        for size, depth in ((0, 0), (0x40000, 2), (0x100000, 2), (0x100000, 4), (0x400000, 4)):
+            name = 'off' if depth == 0 else '%d x %d KiB' % (depth, size >> 10)
+            print('%-20s %10.1f' % (name, run(f.name, args, (size, depth) if depth else None)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""Throughput and allocations of the SEND_OBJECT receive path.
+
+A data stage is written to a file once and then replayed through
+outdata() from a file-backed fake endpoint, first with the buffer
+lending readview() path and then with a copy per buffer as a
+baseline. The destination is /dev/null so only the data path itself
+is measured.
+"""
+
+import os, sys, time, asyncio, argparse, tempfile, tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.packets import MTPData, OperationCode, outdata
+from benchmarks.endpoints import FileOUTEndpoint, CopyingOUTEndpoint
+
+
+def run(cls, path, bufsize, trace):
+    ep = cls(path, bufsize)
+    dest = open('/dev/null', 'wb')
+    if trace:
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        blocks = sys.getallocatedblocks()
+    t = time.perf_counter()
+    asyncio.run(outdata(ep, OperationCode.encmapping['SEND_OBJECT'], 1, dest))
+    t = time.perf_counter() - t
+    if trace:
+        blocks = sys.getallocatedblocks() - blocks
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peak -= before
+    else:
+        blocks = peak = 0
+    ep.close()
+    dest.close()
+    return t, peak, blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SEND_OBJECT receive benchmark.')
+    parser.add_argument('--size', type=int, help='Object size in MiB.', default=256)
+    parser.add_argument('--bufsize', type=int, help='Endpoint read size.', default=0x10000)
+    args = parser.parse_args()
+
+    length = args.size << 20
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(MTPData.build(dict(length=length + 12, code='SEND_OBJECT', tx_id=1)))
+        chunk = os.urandom(1 << 20)
+        for i in range(args.size):
+            f.write(chunk)
+        f.flush()
+
+        print('%-10s %10s %14s %12s' % ('path', 'MB/s', 'peak B/MiB', 'net blocks'))
+        for name, cls in (('readview', FileOUTEndpoint), ('copy', CopyingOUTEndpoint)):
+            t, _, _ = run(cls, f.name, args.bufsize, False)
+            _, peak, blocks = run(cls, f.name, args.bufsize, True)
+            print('%-10s %10.1f %14.1f %12d' % (name, length / t / 1e6, peak / args.size, blocks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+"""Time taken to scan a storage.
+
+A tree of empty files is created and then loaded by FilesystemStorage,
+with and without --stat-on-scan, and by walking it with pathlib and an
+is_dir() call per entry, which is what the scanner used to do. Each is
+timed with a warm page cache and, when run as root, with a cold one.
+The time to then get the stat of every object, which the first
+GET_OBJECT_INFO for it needs, is also reported.
+"""
+
+import os, sys, time, argparse, tempfile, pathlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.handlemanager import HandleManager
+from mtp.storage import StorageManager, FilesystemStorage
+from benchmarks.tree import NullWatchManager, make_tree
+
+
+def drop_caches():
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+        return True
+    except OSError:
+        return False
+
+
+def pathlib_walk(path):
+    stack = [pathlib.Path(path)]
+    n = 0
+    while stack:
+        for p in stack.pop().iterdir():
+            n += 1
+            if p.is_dir():
+                stack.append(p)
+    return n
+
+
+def scan(path, prestat):
+    hm = HandleManager()
+    storage = FilesystemStorage('Files', path, StorageManager(hm), hm, NullWatchManager(), prestat=prestat)
+    return storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Storage scan benchmark.')
+    parser.add_argument('--files', type=int, help='Number of files to create.', default=100000)
+    parser.add_argument('--per-dir', type=int, help='Files per directory.', default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        make_tree(path, args.files, args.per_dir)
+        print('%-10s %-6s %10s %10s' % ('scanner', 'cache', 'scan s', 'stat s'))
+        for name, fn in (
+            ('pathlib', lambda: pathlib_walk(path)),
+            ('scandir', lambda: scan(path, False)),
+            ('prestat', lambda: scan(path, True)),
+        ):
+            for cache in ('cold', 'warm'):
+                if cache == 'cold' and not drop_caches():
+                    continue
+                t = time.perf_counter()
+                storage = fn()
+                t = time.perf_counter() - t
+                if name == 'pathlib':
+                    print('%-10s %-6s %10.2f %10s' % (name, cache, t, '-'))
+                    continue
+                st = time.perf_counter()
+                for h in storage.handles(recurse=True):
+                    storage.hm[h].cached_stat()
+                st = time.perf_counter() - st
+                print('%-10s %-6s %10.2f %10.2f' % (name, cache, t, st))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""Memory used by the object tree of a storage.
+
+A tree of empty files is created in a temporary directory and then
+loaded by FilesystemStorage and by CompactFilesystemStorage, each in a
+fresh process. The growth of the resident set size while loading is
+reported, scaled to a million objects. Watches are not set up, since
+they live in kernel memory rather than in the process.
+"""
+
+import os, sys, time, argparse, tempfile, multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.handlemanager import HandleManager
+from mtp.storage import StorageManager, FilesystemStorage, CompactFilesystemStorage
+
+
+class NullWatchManager(object):
+
+    def register(self, obj):
+        pass
+
+    def unregister(self, obj):
+        pass
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def load(cls, path, queue):
+    hm = HandleManager()
+    sm = StorageManager(hm)
+    before = rss()
+    t = time.perf_counter()
+    storage = cls('Files', path, sm, hm, NullWatchManager())
+    t = time.perf_counter() - t
+    n = sum(1 for h in storage.handles(recurse=True))
+    queue.put((n, rss() - before, t))
+
+
+def make_tree(path, files, per_dir):
+    dirs = 0
+    for i in range(files):
+        if i % per_dir == 0:
+            d = os.path.join(path, 'd%03d' % (dirs // 100), 'd%05d' % (dirs, ))
+            os.makedirs(d)
+            dirs += 1
+        open(os.path.join(d, 'IMG_%08d.JPG' % (i, )), 'wb').close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Object tree memory benchmark.')
+    parser.add_argument('--files', type=int, help='Number of files to create.', default=200000)
+    parser.add_argument('--per-dir', type=int, help='Files per directory.', default=200)
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory() as path:
+        make_tree(path, args.files, args.per_dir)
+        print('%-10s %10s %14s %14s %10s' % ('tree', 'objects', 'RSS MiB', 'MiB/M objects', 'load s'))
+        for name, cls in (('objects', FilesystemStorage), ('compact', CompactFilesystemStorage)):
+            queue = ctx.Queue()
+            p = ctx.Process(target=load, args=(cls, path, queue))
+            p.start()
+            n, grown, t = queue.get()
+            p.join()
+            print('%-10s %10d %14.1f %14.1f %10.2f' % (name, n, grown / 2**20, grown / 2**20 * 1e6 / n, t))
+
+
+if __name__ == '__main__':
+    main()
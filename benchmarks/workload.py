@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+"""Host workloads replayed against the responder.
+
+An MTPResponder is set up on a temporary storage with fake endpoints
+in the same process, and a scripted host drives it through them, one
+transaction at a time, the way these hosts do:
+
+    browse      Windows Explorer opening folders: the handles in each
+                folder, then the info and property list of every object
+    enumerate   libmtp listing the whole device: handles and info for
+                every folder, recursively
+    upload      copying many small files to the device
+    partial     writing large files in chunks with SEND_PARTIAL_OBJECT,
+                then cutting them short with TRUNCATE_OBJECT, the way
+                Android-aware hosts edit objects; the write-behind
+                thread takes the writes unless --write-behind is 0
+    stream      a media player reading large files in chunks with
+                GET_PARTIAL_OBJECT, seeking now and then, through the
+                read-ahead thread unless --no-read-ahead is given
+    stream-zc   the same, with the file mapped and handed to the
+                endpoint without copying
+
+Nothing waits for a bus or a disk, so the figures are the cost of the
+responder itself. Transactions per second and MB/s are reported for
+each workload, with latency percentiles for each operation. Every
+transaction must get exactly one response with its own transaction
+ID within --timeout seconds, or the benchmark stops.
+"""
+
+import os, sys, time, random, struct, asyncio, argparse, tempfile, collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.responder import MTPResponder
+from mtp.packets import OperationStruct, DataStruct, OperationCode, ResponseCode, DataFormats, OPERATION, DATA
+from mtp.object import ObjectInfo
+from benchmarks.endpoints import MemoryOUTEndpoint, MemoryINEndpoint, MemoryINTEndpoint
+from benchmarks.tree import make_tree
+
+
+class Host(object):
+
+    def __init__(self, outep, inep, timeout):
+        self.outep = outep
+        self.inep = inep
+        self.timeout = timeout
+        self.tx_id = 0
+        self.latency = collections.defaultdict(list)
+        self.bytes = 0
+
+    async def transaction(self, name, *params, data=None):
+        self.tx_id += 1
+        code = OperationCode.encmapping[name]
+        params = params + (0, ) * (5 - len(params))
+        response = self.inep.expect()
+        t = time.perf_counter()
+        self.outep.push(OperationStruct.pack(OperationStruct.size, OPERATION, code, self.tx_id, *params))
+        if data is not None:
+            self.outep.push(DataStruct.pack(DataStruct.size + len(data), DATA, code, self.tx_id) + data)
+            self.bytes += len(data)
+        try:
+            p, payload = await asyncio.wait_for(response, self.timeout)
+        except asyncio.TimeoutError:
+            raise Exception('%s got no response' % (name, ))
+        self.latency[name].append(time.perf_counter() - t)
+        self.bytes += self.inep.received
+        if self.inep.stray:
+            raise Exception('%s: %d responses to no transaction' % (name, self.inep.stray))
+        if p.tx_id != self.tx_id:
+            raise Exception('%s got the response to transaction %d' % (name, p.tx_id))
+        if p.code != ResponseCode.encmapping['OK']:
+            raise Exception('%s failed: %s' % (name, ResponseCode.decmapping.get(p.code, hex(p.code))))
+        return p, payload
+
+    async def handles(self, storage, parent):
+        p, data = await self.transaction('GET_OBJECT_HANDLES', storage, 0, parent)
+        return DataFormats['AUINT32'].parse(data)
+
+    async def info(self, handle):
+        p, data = await self.transaction('GET_OBJECT_INFO', handle)
+        return ObjectInfo.parse(data)
+
+    async def connect(self):
+        await self.transaction('OPEN_SESSION', 1)
+        await self.transaction('GET_DEVICE_INFO')
+        p, data = await self.transaction('GET_STORAGE_IDS')
+        storages = DataFormats['AUINT32'].parse(data)
+        for s in storages:
+            await self.transaction('GET_STORAGE_INFO', s)
+        return storages[0]
+
+
+async def browse(host, storage, args):
+    folders = collections.deque([0xffffffff])
+    opened = 0
+    while folders and opened < args.browse:
+        children = await host.handles(storage, folders.popleft())
+        opened += 1
+        for h in children:
+            if (await host.info(h)).format == 'ASSOCIATION':
+                folders.append(h)
+            await host.transaction('GET_OBJECT_PROP_LIST', h, 0, 0xffffffff, 0, 0)
+
+
+async def enumerate_all(host, storage, args):
+    folders = [0xffffffff]
+    while folders:
+        for h in await host.handles(storage, folders.pop()):
+            if (await host.info(h)).format == 'ASSOCIATION':
+                folders.append(h)
+
+
+async def upload(host, storage, args):
+    data = os.urandom(args.upload_size)
+    for i in range(args.uploads):
+        info = ObjectInfo.build(dict(storage_id=storage, format='UNDEFINED', compressed_size=len(data), parent_object=0, association_type='UNDEFINED', filename='UP_%06d.BIN' % (i, )))
+        await host.transaction('SEND_OBJECT_INFO', storage, 0xffffffff, data=info)
+        await host.transaction('SEND_OBJECT', data=data)
+
+
+async def partial(host, storage, args):
+    data = os.urandom(args.chunk)
+    size = args.partial_size << 20
+    for i in range(args.partials):
+        info = ObjectInfo.build(dict(storage_id=storage, format='UNDEFINED', compressed_size=len(data), parent_object=0, association_type='UNDEFINED', filename='PART_%04d.BIN' % (i, )))
+        p, _ = await host.transaction('SEND_OBJECT_INFO', storage, 0xffffffff, data=info)
+        h = p.p3
+        await host.transaction('SEND_OBJECT', data=data)
+        await host.transaction('BEGIN_EDIT_OBJECT', h)
+        for offset in range(len(data), size, len(data)):
+            await host.transaction('SEND_PARTIAL_OBJECT', h, offset & 0xffffffff, offset >> 32, len(data), data=data)
+        await host.transaction('TRUNCATE_OBJECT', h, size - len(data) // 2)
+        await host.transaction('END_EDIT_OBJECT', h)
+        if (await host.info(h)).compressed_size != size - len(data) // 2:
+            raise Exception('PART_%04d.BIN has the wrong size' % (i, ))
+
+
+async def stream(host, storage, args):
+    rng = random.Random(0)
+    files = []
+    for h in await host.handles(storage, 0xffffffff):
+        info = await host.info(h)
+        if info.filename.startswith('VID_'):
+            files.append((h, info.compressed_size))
+    async def read(h, size, offset):
+        p, data = await host.transaction('GET_PARTIAL_OBJECT', h, offset, args.chunk)
+        # Reads which run past the end must say how much they sent.
+        if p.p1 != host.inep.received or p.p1 != min(args.chunk, size - offset):
+            raise Exception('GET_PARTIAL_OBJECT at %d said %d bytes, sent %d' % (offset, p.p1, host.inep.received))
+        return p.p1
+
+    for h, size in files:
+        offset = 0
+        while offset < size:
+            offset += await read(h, size, offset)
+            if rng.random() < 0.05:
+                offset = rng.randrange(size)
+        # Make sure at least one read crosses the end of the file.
+        await read(h, size, max(0, size - args.chunk // 2))
+
+
+def percentile(values, q):
+    return values[int(q * (len(values) - 1))]
+
+
+def run(path, args):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    outep = MemoryOUTEndpoint()
+    inep = MemoryINEndpoint()
+    intep = MemoryINTEndpoint()
+    outep.writebehind = args.write_behind
+    if args.read_ahead:
+        inep.readahead = (0x100000, 4)
+    options = argparse.Namespace(
+        name='Benchmark', storage=[('Files', path)], index=None, lazy=args.lazy, compact=args.compact,
+        prestat=False, scan_workers=1, watch_budget=None,
+    )
+    MTPResponder(outep, inep, intep, loop, options)
+    host = Host(outep, inep, args.timeout)
+    storage = loop.run_until_complete(host.connect())
+
+    totals = []
+    print('%-10s %-22s %8s %10s %10s %10s %10s' % ('workload', 'operation', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for name, workload, zerocopy in (
+        ('browse', browse, False), ('enumerate', enumerate_all, False), ('upload', upload, False),
+        ('partial', partial, False), ('stream', stream, False), ('stream-zc', stream, True),
+    ):
+        inep.zerocopy = zerocopy
+        host.latency.clear()
+        host.bytes = 0
+        t = time.perf_counter()
+        loop.run_until_complete(workload(host, storage, args))
+        t = time.perf_counter() - t
+        count = 0
+        for op, latency in sorted(host.latency.items()):
+            latency.sort()
+            count += len(latency)
+            print('%-10s %-22s %8d %10.3f %10.3f %10.3f %10.3f' % (
+                name, op, len(latency), percentile(latency, 0.5) * 1000, percentile(latency, 0.9) * 1000,
+                percentile(latency, 0.99) * 1000, latency[-1] * 1000,
+            ))
+        totals.append((name, count, t, count / t, host.bytes / t / 1e6))
+
+    print()
+    print('%-10s %8s %10s %10s %10s' % ('workload', 'count', 'seconds', 'tx/s', 'MB/s'))
+    for total in totals:
+        print('%-10s %8d %10.2f %10.1f %10.1f' % total)
+
+    loop.close()
+    outep.close()
+    intep.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Host workload benchmark.')
+    parser.add_argument('--files', type=int, help='Number of files on the storage.', default=20000)
+    parser.add_argument('--per-dir', type=int, help='Files per directory.', default=200)
+    parser.add_argument('--browse', type=int, help='Number of folders opened by the browse workload.', default=20)
+    parser.add_argument('--uploads', type=int, help='Number of files uploaded.', default=500)
+    parser.add_argument('--upload-size', type=int, help='Size of each uploaded file.', default=0x4000)
+    parser.add_argument('--partials', type=int, help='Number of files written in chunks.', default=2)
+    parser.add_argument('--partial-size', type=int, help='Size of each file written in chunks in MiB.', default=64)
+    parser.add_argument('--streams', type=int, help='Number of large files streamed.', default=2)
+    parser.add_argument('--stream-size', type=int, help='Size of each streamed file in MiB.', default=64)
+    parser.add_argument('--chunk', type=int, help='Size of each partial read or write.', default=0x100000)
+    parser.add_argument('--write-behind', type=int, help='Write-behind limit, 0 to write in the event loop.', default=0x800000)
+    parser.add_argument('--no-read-ahead', action='store_false', dest='read_ahead', help='Read objects in the event loop.')
+    parser.add_argument('--timeout', type=float, help='Seconds to wait for each response.', default=10)
+    parser.add_argument('-l', '--lazy', action='store_true', help='Use a lazily loaded storage.')
+    parser.add_argument('-c', '--compact', action='store_true', help='Use a compact storage.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as path:
+        make_tree(path, args.files, args.per_dir)
+        for i in range(args.streams):
+            with open(os.path.join(path, 'VID_%04d.MP4' % (i, )), 'wb') as f:
+                f.write(os.urandom(args.stream_size << 20))
+        run(path, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+"""SEND_OBJECT from a fast host to a disk which stalls now and then.
+
+A data stage is replayed through outdata() from a fake endpoint which
+delivers buffers at USB 2.0 speed, into a file whose writes are
+throttled and which stalls every few MiB, the way an SD card does when
+it flushes or the journal commits. Reported are the throughput and the
+longest time a received buffer waited to be read from the endpoint,
+which is how long the host would have been held off.
+"""
+
+import os, sys, time, asyncio, argparse, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mtp.packets import MTPData, OperationCode, outdata
+from benchmarks.endpoints import PacedOUTEndpoint
+
+
+class StallingFile(object):
+
+    def __init__(self, rate, every, stall):
+        self.file = open('/dev/null', 'wb')
+        self.rate = rate
+        self.every = every
+        self.stall = stall
+        self.written = 0
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def write(self, buf):
+        before = self.written
+        self.written += len(buf)
+        delay = len(buf) / self.rate
+        if before // self.every != self.written // self.every:
+            delay += self.stall
+        time.sleep(delay)
+        return self.file.write(buf)
+
+    def flush(self):
+        self.file.flush()
+
+
+def run(path, args, writebehind):
+    ep = PacedOUTEndpoint(path, rate=args.usb * 1e6)
+    ep.writebehind = writebehind
+    f = StallingFile(args.disk * 1e6, args.every << 20, args.stall / 1000)
+    t = time.perf_counter()
+    asyncio.run(outdata(ep, OperationCode.encmapping['SEND_OBJECT'], 1, f))
+    t = time.perf_counter() - t
+    ep.close()
+    return (args.size << 20) / t / 1e6, ep.late * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write-behind benchmark.')
+    parser.add_argument('--size', type=int, help='Object size in MiB.', default=32)
+    parser.add_argument('--usb', type=float, help='Endpoint speed in MB/s.', default=40)
+    parser.add_argument('--disk', type=float, help='Disk speed in MB/s.', default=80)
+    parser.add_argument('--every', type=int, help='MiB written between stalls.', default=4)
+    parser.add_argument('--stall', type=float, help='Length of a stall in ms.', default=30)
+    args = parser.parse_args()
+
+    length = args.size << 20
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(MTPData.build(dict(length=length + 12, code='SEND_OBJECT', tx_id=1)))
+        f.write(bytes(length))
+        f.flush()
+        print('%-14s %10s %14s' % ('write-behind', 'MB/s', 'max held ms'))
+        for limit in (0, 0x100000, 0x400000, 0x800000):
+            name = 'off' if limit == 0 else '%d KiB' % (limit >> 10, )
+            print('%-14s %10.1f %14.1f' % ((name, ) + run(f.name, args, limit)))
+
+
+if __name__ == '__main__':
+    main()
@@ -83,6 +83,12 @@ def main():
     parser.add_argument('--udc', type=str, help='UDC device. (dummy_udc.0)', default='dummy_udc.0')
     parser.add_argument('-s', '--storage', action='append', nargs=2, metavar=('name','path'), help='Add storage.')
     parser.add_argument('-n', '--name', type=str, help='MTP device name', default='MTP Device')
+    parser.add_argument('-i', '--index', type=str, help='Keep a persistent storage index in this file so handles survive restarts.', default=None)
+    parser.add_argument('-l', '--lazy', action='store_true', help='Only scan and watch directories when the inquirer looks inside them.')
+    parser.add_argument('-j', '--scan-workers', type=int, help='Number of processes used to scan storages at start up.', default=1)
+    parser.add_argument('--stat-on-scan', action='store_true', dest='prestat', help='Stat every object while scanning, so the first GET_OBJECT_INFO for it needs no syscall. Uses more memory.')
+    parser.add_argument('--watch-budget', type=int, help='Number of inotify watches to use. Directories beyond this are polled. Default: half of fs.inotify.max_user_watches.', default=None)
+    parser.add_argument('-c', '--compact', action='store_true', help='Keep the object tree in compact arrays. Uses less memory on big storages. Not compatible with --index or --lazy.')
 
     parser.add_argument('-v', '--vid', type=str, help='MTP device name', default='0x0430')
     parser.add_argument('-p', '--pid', type=str, help='MTP device name', default='0xa4a2')
@@ -90,7 +96,19 @@ def main():
     parser.add_argument('-P', '--product', type=str, help='MTP device name', default='MTP Device')
     parser.add_argument('-S', '--serialnumber', type=str, help='MTP device name', default='12345678')
 
+    parser.add_argument('--max-burst', type=int, choices=range(16), metavar='0-15', help='SuperSpeed bulk burst size, in packets after the first.', default=15)
+    parser.add_argument('--aio-reads', type=int, help='Number of bulk-OUT reads kept in flight.', default=4)
+    parser.add_argument('--aio-read-size', type=int, help='Size of each bulk-OUT read. Must be a multiple of the max packet size.', default=0x10000)
+    parser.add_argument('--aio-writes', type=int, help='Number of bulk-IN writes kept in flight.', default=4)
+    parser.add_argument('--aio-write-size', type=int, help='Size of each bulk-IN write. Must be a multiple of the max packet size.', default=0x10000)
+    parser.add_argument('--read-ahead-size', type=int, help='Size of each read-ahead buffer used when sending objects.', default=0x100000)
+    parser.add_argument('--read-ahead-depth', type=int, help='Number of read-ahead buffers. 0 reads in the event loop instead.', default=4)
+    parser.add_argument('--write-behind', type=int, help='Bytes of received object data which may wait to be written to disk. 0 writes in the event loop instead.', default=0x800000)
+    parser.add_argument('--no-zero-copy', action='store_false', dest='zerocopy', help='Always copy file data through Python when sending objects.')
+
     args = parser.parse_args()
+    if args.compact and (args.index is not None or args.lazy):
+        parser.error('--compact can not be used with --index or --lazy')
 
     numeric_level = getattr(logging, args.log_level.upper(), None)
     if not isinstance(numeric_level, int):
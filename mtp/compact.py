@@ -0,0 +1,459 @@
+import os
+import stat
+import array
+import pathlib
+import shutil
+import collections
+
+from inotify_simple import flags
+
+import logging
+logger = logging.getLogger(__name__)
+
+from mtp.exceptions import MTPError
+from mtp.handlemanager import INDEX_MASK
+from mtp.filesystem import FSObject, FSDirObject, DIR_FLAGS, renameat
+
+DIR = 1
+DELETED = 2
+
+ROOT = 0
+NONE = 0xffffffff
+
+
+class NodeStore(object):
+
+    """Filesystem tree kept in parallel arrays instead of Python objects.
+
+    Node n has a parent node, a name stored as bytes in a shared blob,
+    flags, and the handle it was given. The children of a directory
+    are a range of the children array, sorted by name, so a child can
+    be found by bisection. Adding a child to a directory whose range is
+    not at the end of the array moves the range to the end first.
+
+    Removed nodes are reused. Names and child ranges which are no longer
+    used are left in place until they make up half of their array, at
+    which point the array is rebuilt.
+
+    Nodes are owners in the handle manager, so looking up a handle gives
+    a short lived view object which has the FSObject API. Watched
+    directories keep one view each because the watch manager holds it.
+    """
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.hm = storage.hm
+        self.path_ = pathlib.Path(path)
+
+        self.parents = array.array('I', [NONE])
+        self.name_offsets = array.array('I', [0])
+        self.name_lengths = array.array('B', [0])
+        self.flags = array.array('B', [DIR])
+        self.handles = array.array('I', [NONE])
+        self.firsts = array.array('I', [0])
+        self.counts = array.array('I', [0])
+        self.children = array.array('I')
+        self.names = bytearray()
+        self.slots = array.array('I')
+        self.unused = []
+        self.garbage_names = 0
+        self.garbage_children = 0
+        self.watched = {}
+
+    def __len__(self):
+        return len(self.parents) - len(self.unused)
+
+    def name(self, node):
+        offset = self.name_offsets[node]
+        return bytes(self.names[offset:offset + self.name_lengths[node]])
+
+    def path(self, node):
+        parts = []
+        while node != ROOT:
+            parts.append(self.name(node))
+            node = self.parents[node]
+        path = self.path_
+        for part in reversed(parts):
+            path = path / os.fsdecode(part)
+        return path
+
+    def fd(self, node):
+        fd = self.storage.dirfds.get(node)
+        if fd is None:
+            if node == ROOT:
+                fd = os.open(str(self.path_), DIR_FLAGS)
+            else:
+                fd = os.open(self.name(node), DIR_FLAGS, dir_fd=self.fd(self.parents[node]))
+            self.storage.dirfds.put(node, fd)
+        return fd
+
+    def view(self, handle):
+        node = self.slots[handle & INDEX_MASK]
+        if node in self.watched:
+            return self.watched[node]
+        if self.flags[node] & DIR:
+            return FSDirNode(self.storage, node, handle)
+        else:
+            return FSNode(self.storage, node, handle)
+
+    def child_range(self, node):
+        first = self.firsts[node]
+        return first, first + self.counts[node]
+
+    def bisect(self, node, name):
+        """Return the position in children where name is or would be."""
+        lo, hi = self.child_range(node)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.name(self.children[mid]) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, node, name):
+        pos = self.bisect(node, name)
+        if pos < self.firsts[node] + self.counts[node] and self.name(self.children[pos]) == name:
+            return self.children[pos]
+        return None
+
+    def set_name(self, node, name):
+        if len(name) > 255:
+            raise MTPError('INVALID_OBJECT_PROP_VALUE')
+        self.garbage_names += self.name_lengths[node]
+        self.name_offsets[node] = len(self.names)
+        self.name_lengths[node] = len(name)
+        self.names += name
+
+    def new_node(self, parent, name, is_dir, handle=None):
+        if self.unused:
+            node = self.unused.pop()
+            self.parents[node] = parent
+            self.flags[node] = DIR if is_dir else 0
+            self.firsts[node] = 0
+            self.counts[node] = 0
+        else:
+            node = len(self.parents)
+            self.parents.append(parent)
+            self.name_offsets.append(0)
+            self.name_lengths.append(0)
+            self.flags.append(DIR if is_dir else 0)
+            self.handles.append(NONE)
+            self.firsts.append(0)
+            self.counts.append(0)
+        self.set_name(node, name)
+        handle = self.hm.claim(self, handle)
+        self.handles[node] = handle
+        slot = handle & INDEX_MASK
+        if slot >= len(self.slots):
+            self.slots.extend(array.array('I', [NONE]) * (slot + 1 - len(self.slots)))
+        self.slots[slot] = node
+        return node
+
+    def scan(self, top=ROOT):
+        """List every directory below top, breadth first.
+
+        Returns the directory nodes which were listed.
+        """
+        queue = collections.deque([top])
+        listed = []
+        while queue:
+            node = queue.popleft()
+            try:
+                with os.scandir(self.fd(node)) as it:
+                    entries = sorted((os.fsencode(e.name), e.is_dir()) for e in it)
+            except OSError as e:
+                logger.warning('Skipping %s: %s' % (self.path(node), e))
+                continue
+            listed.append(node)
+            self.firsts[node] = len(self.children)
+            self.counts[node] = len(entries)
+            for name, is_dir in entries:
+                child = self.new_node(node, name, is_dir)
+                self.children.append(child)
+                if is_dir:
+                    queue.append(child)
+        return listed
+
+    def watch(self):
+        for node in range(len(self.parents)):
+            if self.flags[node] & DIR and not self.flags[node] & DELETED:
+                self.watch_node(node)
+
+    def watch_node(self, node):
+        if node == ROOT:
+            view = self.storage.root
+        else:
+            view = FSDirNode(self.storage, node, self.handles[node])
+        self.watched[node] = view
+        self.storage.wm.register(view)
+
+    def insert(self, parent, node):
+        first, end = self.child_range(parent)
+        if end != len(self.children):
+            self.garbage_children += end - first
+            self.firsts[parent] = len(self.children)
+            self.children.extend(self.children[first:end])
+        self.children.insert(self.bisect(parent, self.name(node)), node)
+        self.counts[parent] += 1
+        self.maybe_rebuild()
+
+    def unlink(self, parent, node):
+        first, end = self.child_range(parent)
+        pos = self.children.index(node, first, end)
+        if end == len(self.children):
+            self.children.pop(pos)
+        else:
+            self.children[pos:end - 1] = self.children[pos + 1:end]
+            self.children[end - 1] = NONE
+            self.garbage_children += 1
+        self.counts[parent] -= 1
+
+    def add(self, parent, name, is_dir, handle=None):
+        if self.find(parent, name) is not None:
+            raise MTPError('INVALID_OBJECT_PROP_VALUE')
+        node = self.new_node(parent, name, is_dir, handle)
+        self.insert(parent, node)
+        if is_dir:
+            # A directory moved in from elsewhere has contents already.
+            for n in self.scan(node):
+                self.watch_node(n)
+        return self.handles[node]
+
+    def remove(self, node):
+        self.unlink(self.parents[node], node)
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if self.flags[n] & DIR:
+                first, end = self.child_range(n)
+                stack.extend(self.children[first:end])
+                self.garbage_children += end - first
+                view = self.watched.pop(n, None)
+                if view is not None:
+                    self.storage.wm.unregister(view)
+                self.storage.dirfds.discard(n)
+            self.hm.unclaim(self.handles[n])
+            self.slots[self.handles[n] & INDEX_MASK] = NONE
+            self.handles[n] = NONE
+            self.flags[n] = DELETED
+            self.garbage_names += self.name_lengths[n]
+            self.name_lengths[n] = 0
+            self.counts[n] = 0
+            self.unused.append(n)
+        self.maybe_rebuild()
+
+    def rename(self, node, name):
+        parent = self.parents[node]
+        first, end = self.child_range(parent)
+        pos = self.children.index(node, first, end)
+        self.children[pos:end - 1] = self.children[pos + 1:end]
+        self.counts[parent] -= 1
+        self.set_name(node, name)
+        pos = self.bisect(parent, name)
+        self.children[pos + 1:end] = self.children[pos:end - 1]
+        self.children[pos] = node
+        self.counts[parent] += 1
+        self.maybe_rebuild()
+
+    def move(self, node, parent, name):
+        self.unlink(self.parents[node], node)
+        self.set_name(node, name)
+        self.parents[node] = parent
+        self.insert(parent, node)
+        if node in self.watched:
+            self.watched[node].name = os.fsdecode(name)
+
+    def maybe_rebuild(self):
+        if self.garbage_names > 0x100000 and self.garbage_names * 2 > len(self.names):
+            names = bytearray()
+            for node in range(len(self.parents)):
+                offset = self.name_offsets[node]
+                length = self.name_lengths[node]
+                self.name_offsets[node] = len(names)
+                names += self.names[offset:offset + length]
+            self.names = names
+            self.garbage_names = 0
+        if self.garbage_children > 0x40000 and self.garbage_children * 2 > len(self.children):
+            children = array.array('I')
+            for node in range(len(self.parents)):
+                if self.flags[node] & DIR:
+                    first, end = self.child_range(node)
+                    self.firsts[node] = len(children)
+                    children.extend(self.children[first:end])
+            self.children = children
+            self.garbage_children = 0
+
+
+class FSNode(FSObject):
+
+    """View of a node in a NodeStore."""
+
+    __slots__ = ('node', )
+
+    def __init__(self, storage, node, handle):
+        self.storage = storage
+        self.node = node
+        self.handle = handle
+        self.parent = None
+        self.name = os.fsdecode(storage.nodes.name(node))
+        self.info = None
+        self.st = None
+
+    def path(self):
+        return self.storage.nodes.path(self.node)
+
+    def dirfd(self):
+        return self.storage.nodes.fd(self.storage.nodes.parents[self.node])
+
+    def parent_handle(self):
+        parent = self.storage.nodes.parents[self.node]
+        return 0 if parent == ROOT else self.storage.nodes.handles[parent]
+
+    def delete(self):
+        fd = self.dirfd()
+        path = self.path()
+        self.storage.nodes.remove(self.node)
+        try:
+            os.unlink(self.name, dir_fd=fd)
+        except IsADirectoryError:
+            shutil.rmtree(str(path))
+
+    def rename(self, name):
+        nodes = self.storage.nodes
+        if name in ('', '.', '..') or '/' in name or nodes.find(nodes.parents[self.node], os.fsencode(name)) is not None:
+            raise MTPError('INVALID_OBJECT_PROP_VALUE')
+        renameat(self.dirfd(), self.name, name)
+        nodes.rename(self.node, os.fsencode(name))
+        self.name = name
+        self.invalidate()
+
+    def verify(self):
+        assert(self.storage.nodes.handles[self.node] == self.handle)
+        super().verify()
+
+
+class FSDirNode(FSNode):
+
+    """View of a directory node in a NodeStore."""
+
+    __slots__ = ()
+
+    create_or_reserve = FSDirObject.create_or_reserve
+    open_child = FSDirObject.open_child
+    truncate = FSDirObject.truncate
+    partial_file = FSDirObject.partial_file
+
+    def handle_as_parent(self):
+        return self.handle
+
+    def fd(self):
+        return self.storage.nodes.fd(self.node)
+
+    def add_child(self, name, handle=None, cache=True):
+        # Nodes don't cache stat results.
+        is_dir = stat.S_ISDIR(os.stat(name, dir_fd=self.fd()).st_mode)
+        return self.storage.nodes.add(self.node, os.fsencode(name), is_dir, handle)
+
+    def child_names(self):
+        nodes = self.storage.nodes
+        first, end = nodes.child_range(self.node)
+        return set(os.fsdecode(nodes.name(c)) for c in nodes.children[first:end])
+
+    def handles(self, recurse=False):
+        nodes = self.storage.nodes
+        first, end = nodes.child_range(self.node)
+        children = nodes.children[first:end]
+        if not recurse:
+            return (nodes.handles[c] for c in children)
+        return self.walk(children)
+
+    def walk(self, children):
+        nodes = self.storage.nodes
+        stack = list(reversed(children))
+        while stack:
+            node = stack.pop()
+            yield nodes.handles[node]
+            if nodes.flags[node] & DIR:
+                first, end = nodes.child_range(node)
+                stack.extend(reversed(nodes.children[first:end]))
+
+    def inotify(self, event):
+        """Apply a change to this directory, as FSDirObject.inotify() does."""
+        nodes = self.storage.nodes
+        sm = self.storage.sm
+        if event.name == '':
+            if event.mask & flags.ATTRIB and self.node != ROOT:
+                sm.event('OBJECT_INFO_CHANGED', self.handle)
+            return
+
+        child = nodes.find(self.node, os.fsencode(event.name))
+        if event.mask & (flags.CREATE | flags.MOVED_TO):
+            if child is None:
+                try:
+                    handle = self.add_child(event.name)
+                except FileNotFoundError:
+                    return
+                sm.event('OBJECT_ADDED', handle)
+            elif event.mask & flags.MOVED_TO:
+                sm.event('OBJECT_INFO_CHANGED', nodes.handles[child])
+
+        elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+            if child is not None:
+                handle = nodes.handles[child]
+                nodes.remove(child)
+                sm.event('OBJECT_REMOVED', handle)
+
+        elif child is not None and event.mask & (flags.ATTRIB | flags.CLOSE_WRITE):
+            sm.event('OBJECT_INFO_CHANGED', nodes.handles[child])
+
+    def move(self, name, dest, newname):
+        """Move a child to dest, as FSDirObject.move() does."""
+        nodes = self.storage.nodes
+        child = nodes.find(self.node, os.fsencode(name))
+        if child is None or dest.storage is not self.storage:
+            return False
+        sm = self.storage.sm
+        target = nodes.find(dest.node, os.fsencode(newname))
+        if target is not None:
+            handle = nodes.handles[target]
+            nodes.remove(target)
+            sm.event('OBJECT_REMOVED', handle)
+        nodes.move(child, dest.node, os.fsencode(newname))
+        sm.event('OBJECT_INFO_CHANGED', nodes.handles[child])
+        return True
+
+    def verify(self):
+        nodes = self.storage.nodes
+        first, end = nodes.child_range(self.node)
+        names = [nodes.name(c) for c in nodes.children[first:end]]
+        assert(names == sorted(names))
+        assert(sorted(names) == sorted(os.fsencode(p.name) for p in self.path().iterdir()))
+        for c in nodes.children[first:end]:
+            assert(nodes.parents[c] == self.node)
+            self.storage.hm[nodes.handles[c]].verify()
+
+
+class FSRootNode(FSDirNode):
+
+    """The storage root of a NodeStore."""
+
+    __slots__ = ()
+
+    def __init__(self, storage):
+        super().__init__(storage, ROOT, NONE)
+        self.name = ''
+
+    def path(self):
+        return self.storage.nodes.path_
+
+    def handle_as_parent(self):
+        return 0xffffffff
+
+    def delete(self):
+        logger.error('Cannot delete the storage root.')
+
+    def verify(self):
+        super().verify()
+        self.storage.hm.verify()
+        self.storage.wm.verify()
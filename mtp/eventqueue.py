@@ -0,0 +1,71 @@
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+OBJECT_EVENTS = ('OBJECT_ADDED', 'OBJECT_REMOVED', 'OBJECT_INFO_CHANGED')
+
+
+class EventQueue(object):
+
+    """Bounded queue of events waiting for the interrupt endpoint.
+
+    Object events are coalesced so that each handle has at most one
+    event queued: further INFO_CHANGED events are dropped, an object
+    which is added and removed again before the host heard of it is
+    not reported at all, and a removal replaces a pending INFO_CHANGED.
+
+    If more than limit events are waiting, typically because something
+    on the device changed a whole tree or the host is not polling the
+    interrupt endpoint, the queue is replaced by a single
+    UNREPORTED_STATUS, which tells the host that events were lost and
+    it should read the object lists again. Nothing more is queued until
+    that has been sent.
+    """
+
+    def __init__(self, limit=256):
+        self.limit = limit
+        self.events = collections.OrderedDict()
+        self.overflowed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def put(self, code, p1=0):
+        if self.overflowed:
+            self.dropped += 1
+            return
+        if code not in OBJECT_EVENTS:
+            self.events[(code, p1)] = code
+        else:
+            pending = self.events.get(p1)
+            if pending is None:
+                self.events[p1] = code
+            elif code == 'OBJECT_REMOVED':
+                if pending == 'OBJECT_ADDED':
+                    del self.events[p1]
+                else:
+                    self.events[p1] = code
+            elif code == 'OBJECT_ADDED':
+                del self.events[p1]
+                self.events[p1] = code
+            # else INFO_CHANGED, which is covered by the pending event
+        if len(self.events) > self.limit:
+            logger.warning('Event queue overflowed, asking the host to resync.')
+            self.dropped += len(self.events)
+            self.events.clear()
+            self.events[('UNREPORTED_STATUS', 0)] = 'UNREPORTED_STATUS'
+            self.overflowed = True
+
+    def get(self):
+        """Remove and return the oldest event as (code, p1)."""
+        key, code = self.events.popitem(last=False)
+        if code == 'UNREPORTED_STATUS':
+            self.overflowed = False
+        return code, (key if code in OBJECT_EVENTS else key[1])
+
+    def clear(self):
+        self.events.clear()
+        self.overflowed = False
@@ -1,30 +1,122 @@
+import os
+import stat
+import errno
 import pathlib
 import shutil
 import itertools
 import datetime
+import collections
 
 from inotify_simple import flags
 
 import logging
 logger = logging.getLogger(__name__)
 
-from mtp.object import ObjectInfo
+from mtp.object import ObjectInfo, FormatType
 from mtp.partialfile import PartialFile
 from mtp.exceptions import MTPError
 
+FORMAT_UNDEFINED = FormatType.encmapping['UNDEFINED']
+FORMAT_ASSOCIATION = FormatType.encmapping['ASSOCIATION']
+
+DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC
+
+OPEN_FLAGS = {
+    'rb': os.O_RDONLY,
+    'r+b': os.O_RDWR,
+    'wb': os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+}
+
+
+def openat(dirfd, name, mode='rb'):
+    """Open a file relative to a directory fd, like open()."""
+    return open(os.open(name, OPEN_FLAGS[mode] | os.O_CLOEXEC, 0o666, dir_fd=dirfd), mode)
+
+
+RENAME_ERRORS = {
+    errno.EACCES: 'ACCESS_DENIED',
+    errno.EPERM: 'ACCESS_DENIED',
+    errno.EROFS: 'STORE_READ_ONLY',
+}
+
+
+def renameat(dirfd, name, newname):
+    """Rename an entry of a directory fd without replacing another.
+
+    The children known to the caller may not be all there is on disk,
+    so the new name is looked up first. Errors are raised as MTPError.
+    """
+    if newname in ('', '.', '..') or '/' in newname:
+        raise MTPError('INVALID_OBJECT_PROP_VALUE')
+    try:
+        os.stat(newname, dir_fd=dirfd, follow_symlinks=False)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        raise MTPError(RENAME_ERRORS.get(e.errno, 'INVALID_OBJECT_PROP_VALUE'))
+    else:
+        raise MTPError('INVALID_OBJECT_PROP_VALUE')
+    try:
+        os.rename(name, newname, src_dir_fd=dirfd, dst_dir_fd=dirfd)
+    except OSError as e:
+        raise MTPError(RENAME_ERRORS.get(e.errno, 'INVALID_OBJECT_PROP_VALUE'))
+
+
+class DirFDCache(object):
+
+    """Bounded LRU of open directory file descriptors.
+
+    Filesystem operations are done relative to the fd of the directory
+    containing the object, so the kernel only has to resolve one path
+    component no matter how deep the object is. Each directory is
+    opened relative to its parent's fd, so opening one is cheap too.
+    """
+
+    def __init__(self, size=64):
+        self.size = size
+        self.fds = collections.OrderedDict()
+
+    def get(self, key):
+        fd = self.fds.get(key)
+        if fd is not None:
+            self.fds.move_to_end(key)
+        return fd
+
+    def put(self, key, fd):
+        self.fds[key] = fd
+        if len(self.fds) > self.size:
+            os.close(self.fds.popitem(last=False)[1])
+        return fd
+
+    def discard(self, key):
+        fd = self.fds.pop(key, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds.clear()
+
 
 class FSObject(object):
 
-    __slots__ = ('parent', 'storage', 'name', 'handle', 'wd')
+    __slots__ = ('parent', 'storage', 'name', 'handle', 'wd', 'info', 'st')
 
-    def __init__(self, path, parent, storage):
+    def __init__(self, name, parent, storage):
         self.parent = parent
         self.storage = storage
-        self.name = path.name
+        self.name = name
+        self.info = None
+        self.st = None
 
     def path(self):
         return self.parent.path() / self.name
 
+    def dirfd(self):
+        """Return an fd for the directory containing this object."""
+        return self.parent.fd()
+
     def unwatch(self):
         pass
 
@@ -32,47 +124,107 @@ class FSObject(object):
         pass
 
     def create_or_reserve(self, info):
-        raise MTPError('INVALID_PARENT_HANDLE')
+        raise MTPError('INVALID_PARENT_OBJECT')
 
     def delete(self):
         self.unwatch()
+        self.remove_from_disk()
+        self.forget()
+
+    def forget(self):
+        """Drop this object and everything below it from the storage."""
         self.unregister_children()
-        if self.path().is_dir():
-            shutil.rmtree(str(self.path()))
-        else:
-            self.path().unlink()
         del self.parent.children[self.name]
+        self.parent.invalidate()
+        handle = self.handle
+        self.storage.hm.unregister(self)
+        if self.storage.index is not None:
+            self.storage.index.remove(self.storage.key, handle)
+            self.storage.index.forget_dir(self.storage.key, self.parent.handle_as_parent())
+
+    def remove_from_disk(self):
+        try:
+            os.unlink(self.name, dir_fd=self.dirfd())
+        except IsADirectoryError:
+            shutil.rmtree(str(self.path()))
 
     def truncate(self, offset):
-        self.path().open('r+b').truncate(offset)
+        self.invalidate()
+        fd = os.open(self.name, os.O_WRONLY | os.O_CLOEXEC, dir_fd=self.dirfd())
+        try:
+            os.ftruncate(fd, offset)
+        finally:
+            os.close(fd)
 
     def partial_file(self, offset, length):
-        f = self.path().open('r+b')
+        self.invalidate() # it might be written to
+        f = self.open(mode='r+b')
         return PartialFile(f, offset, length)
 
     def handles(self, recurse):
-        raise MTPError('INVALID_PARENT_HANDLE')
+        raise MTPError('INVALID_PARENT_OBJECT')
 
     def handle_as_parent(self):
         return self.handle
 
+    def invalidate(self):
+        self.info = None
+        self.st = None
+
+    def cached_stat(self):
+        if self.st is None:
+            self.st = os.stat(self.name, dir_fd=self.dirfd())
+        return self.st
+
+    def parent_handle(self):
+        return 0 if isinstance(self.parent, FSRootObject) else self.parent.handle
+
     def build(self):
-        path = self.path()
-        stat = path.stat()
-        is_dir = path.is_dir()
-        return ObjectInfo.build(dict(
+        if self.info is not None:
+            self.storage.info_hits += 1
+            return self.info
+        self.storage.info_misses += 1
+        st = self.cached_stat()
+        is_dir = stat.S_ISDIR(st.st_mode)
+        self.info = ObjectInfo.build(dict(
             storage_id=self.storage.storage_id,
-            compressed_size=stat.st_size,
-            parent_object=0 if isinstance(self.parent, FSRootObject) else self.parent.handle,
-            filename=path.name,
+            compressed_size=st.st_size,
+            parent_object=self.parent_handle(),
+            filename=self.name,
             format='ASSOCIATION' if is_dir else 'UNDEFINED',
             association_type='GENERIC_FOLDER' if is_dir else 'UNDEFINED',
-            ctime = datetime.datetime.fromtimestamp(stat.st_ctime),
-            mtime = datetime.datetime.fromtimestamp(stat.st_mtime),
+            ctime = datetime.datetime.fromtimestamp(st.st_ctime),
+            mtime = datetime.datetime.fromtimestamp(st.st_mtime),
         ))
+        return self.info
+
+    def properties(self):
+        """Return the values of all supported object properties."""
+        st = self.cached_stat()
+        return {
+            'STORAGE_ID': self.storage.storage_id,
+            'OBJECT_FORMAT': FORMAT_ASSOCIATION if stat.S_ISDIR(st.st_mode) else FORMAT_UNDEFINED,
+            'PROTECTION_STATUS': 0,
+            'OBJECT_SIZE': st.st_size,
+            'OBJECT_FILE_NAME': self.name,
+            'DATE_MODIFIED': datetime.datetime.fromtimestamp(st.st_mtime).strftime('%Y%m%dT%H%M%SZ'),
+            'PARENT_OBJECT': self.parent_handle(),
+        }
+
+    def rename(self, name):
+        if name in self.parent.children:
+            raise MTPError('INVALID_OBJECT_PROP_VALUE')
+        renameat(self.dirfd(), self.name, name)
+        del self.parent.children[self.name]
+        self.name = name
+        self.parent.children[name] = self
+        self.invalidate()
+        self.parent.invalidate()
+        if self.storage.index is not None:
+            self.storage.index.rename(self.storage.key, self.parent.handle_as_parent(), self.handle, name)
 
-    def open(self, **kwargs):
-        return self.path().open(**kwargs)
+    def open(self, mode='rb'):
+        return openat(self.dirfd(), self.name, mode)
 
     def verify(self):
         assert(self.path().exists())
@@ -82,43 +234,158 @@ class FSObject(object):
 
 class FSDirObject(FSObject):
 
-    __slots__ = ('children',)
-
-    def __init__(self, path, parent, storage):
-        super().__init__(path, parent, storage)
-        self.children = {}
-        self.storage.wm.register(self)
+    __slots__ = ('children', 'pathcache', 'pathepoch')
 
-        for fz in self.path().iterdir():
-            self.add_child(fz)
+    def __init__(self, name, parent, storage):
+        super().__init__(name, parent, storage)
+        self.children = None
+        self.pathcache = None
+        self.pathepoch = None
 
-    def add_child(self, path, handle=None):
-        if path.is_dir():
-            obj = FSDirObject(path, self, self.storage)
+    def path(self):
+        # Renaming any directory bumps the storage's epoch, which makes
+        # every cached path stale.
+        if self.pathepoch != self.storage.path_epoch:
+            self.pathcache = self.parent.path() / self.name
+            self.pathepoch = self.storage.path_epoch
+        return self.pathcache
+
+    def fd(self):
+        fd = self.storage.dirfds.get(self)
+        if fd is None:
+            fd = self.storage.dirfds.put(self, os.open(self.name, DIR_FLAGS, dir_fd=self.dirfd()))
+        return fd
+
+    def rename(self, name):
+        super().rename(name)
+        self.storage.path_epoch += 1
+
+    def open_child(self, name, mode):
+        return openat(self.fd(), name, mode)
+
+    def load(self):
+        """Watch the directory and create its children, if not done yet.
+
+        Must be called after this object has a handle. In lazy storages
+        this is put off until the children are needed, so directories
+        which are never visited cost no memory and no inotify watch.
+        """
+        if self.children is None:
+            self.children = {}
+            self.storage.wm.register(self)
+            self.scan()
+
+    def listdir(self, want_stat):
+        """Return (name, is_dir, stat) for each entry in the directory.
+
+        is_dir comes from d_type in the directory read, so this needs no
+        stat unless want_stat is set. The whole listing is read before
+        any child is created, because loading children opens other
+        directory fds which may close this one.
+
+        While the storage is being set up from an Indexer the listing
+        comes from there instead.
+        """
+        if self.storage.listings is not None:
+            return next(self.storage.listings)
+        entries = []
+        with os.scandir(self.fd()) as it:
+            for fz in it:
+                try:
+                    if want_stat:
+                        st = fz.stat()
+                        entries.append((fz.name, stat.S_ISDIR(st.st_mode), st))
+                    else:
+                        entries.append((fz.name, fz.is_dir(), None))
+                except OSError:
+                    logger.warning('Skipping %s: can\'t stat it.' % (self.path() / fz.name, ))
+        return entries
+
+    def scan(self):
+        index = self.storage.index
+        if index is None:
+            for name, is_dir, st in self.listdir(self.storage.prestat):
+                self.new_child(name, None, is_dir, st)
+            return
+
+        st = os.stat(self.fd())
+        valid, rows = index.children(self.storage.key, self.handle_as_parent(), st.st_mtime_ns)
+        if valid:
+            for handle, name, is_dir, inode in rows:
+                self.new_child(name, handle, is_dir)
+            return
+
+        # The directory changed since it was indexed. Keep the old handles
+        # of entries which still exist, following renames by inode.
+        byname = {r[1]: r for r in rows}
+        byinode = {r[3]: r for r in rows}
+        used = set()
+        entries = []
+        for name, is_dir, fst in self.listdir(True):
+            handle = None
+            for r in (byname.get(name), byinode.get(fst.st_ino)):
+                if r is not None and r[0] not in used and r[2] == is_dir:
+                    handle = r[0]
+                    used.add(handle)
+                    break
+            handle = self.new_child(name, handle, is_dir, fst)
+            entries.append((handle, name, is_dir, fst.st_ino, fst.st_size, fst.st_mtime_ns))
+        removed = [r[0] for r in rows if r[0] not in used]
+        index.update_dir(self.storage.key, self.handle_as_parent(), st.st_mtime_ns, entries, removed)
+
+    def new_child(self, name, handle, is_dir, st=None):
+        if is_dir:
+            obj = FSDirObject(name, self, self.storage)
         else:
-            obj = FSObject(path, self, self.storage)
+            obj = FSObject(name, self, self.storage)
+        obj.st = st
         self.children[obj.name] = obj
         self.storage.hm.register(obj, handle)
+        if is_dir and not self.storage.lazy:
+            obj.load()
         return obj.handle
 
+    def add_child(self, name, handle=None, cache=True):
+        """Add an object which was just created in this directory.
+
+        cache=False is for a file which is about to be written, so its
+        stat is not kept.
+        """
+        self.load()
+        st = os.stat(name, dir_fd=self.fd())
+        is_dir = stat.S_ISDIR(st.st_mode)
+        handle = self.new_child(name, handle, is_dir, st if cache else None)
+        self.invalidate()
+        if self.storage.index is not None:
+            self.storage.index.add(self.storage.key, self.handle_as_parent(), handle, name, is_dir, st)
+        return handle
+
+    def child_names(self):
+        return set(self.children)
+
     def unwatch(self):
+        if self.children is None:
+            return
         self.storage.wm.unregister(self)
-        for c in self.children:
+        for c in self.children.values():
             c.unwatch()
 
     def unregister_children(self):
-        for c in self.children:
-            self.hm.unregister(c)
+        # The directory is going away, so its fd is no use any more.
+        self.storage.dirfds.discard(self)
+        if self.children is None:
+            return
+        for c in self.children.values():
+            self.storage.hm.unregister(c)
             c.unregister_children()
 
     def create_or_reserve(self, info):
         if info.format == 'ASSOCIATION' and info.association_type == 'GENERIC_FOLDER':
-            self.path().mkdir(info.name)
-            return self.add_child(self.path() / info.filename)
+            os.mkdir(info.filename, dir_fd=self.fd())
+            return self.add_child(info.filename)
         elif info.compressed_size == 0:
-            f = (self.path() / info.filename).open('wb')
-            f.close()
-            return self.add_child(self.path() / info.filename)
+            self.open_child(info.filename, 'wb').close()
+            return self.add_child(info.filename)
         else:
             return self.storage.hm.reserve_handle()
 
@@ -129,30 +396,83 @@ class FSDirObject(FSObject):
         raise MTPError('INVALID_OBJECT_HANDLE')  # TODO: is this the right error?
 
     def inotify(self, event):
-        if event.mask & (flags.ATTRIB | flags.MODIFY):
-            logger.debug('MODIFY: %s:%s %s' % (self.storage.name, self.path(), event.name))
-
-        elif event.mask & (flags.CREATE):
-            logger.debug('CREATE: %s:%s %s' % (self.storage.name, self.path(), event.name))
-
-        elif event.mask & (flags.CLOSE_WRITE):
-            logger.debug('CLOSE_WRITE: %s:%s %s' % (self.storage.name, self.path(), event.name))
-
-        elif event.mask & (flags.DELETE):
-            logger.debug('DELETE: %s:%s %s' % (self.storage.name, self.path(), event.name))
-
-        elif event.mask & (flags.MOVED_FROM):
-            logger.debug('MOVED_FROM: %s:%s %s' % (self.storage.name, self.path(), event.name))
-
-        elif event.mask & (flags.MOVED_TO):
-            logger.debug('MOVED_TO: %s:%s %s' % (self.storage.name, self.path(), event.name))
-
-        else:
-            logger.warning('EVENT UNHANDLED: %s:%s %s' % (self.storage.name, self.path(), event.name))
-
-        logger.debug('inotify event handling complete.')
+        """Apply a change to this directory and queue the MTP event for it.
+
+        Changes made by the responder itself are already applied by the
+        time their events arrive, so those only refresh cached metadata.
+        """
+        sm = self.storage.sm
+        if event.name == '':
+            self.invalidate()
+            if event.mask & flags.ATTRIB and self.parent is not None:
+                sm.event('OBJECT_INFO_CHANGED', self.handle)
+            return
+
+        # Adding or removing entries changes the mtime of this directory.
+        if event.mask & (flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO):
+            self.invalidate()
+
+        child = self.children.get(event.name)
+        if event.mask & (flags.CREATE | flags.MOVED_TO):
+            if child is None:
+                try:
+                    handle = self.add_child(event.name)
+                except FileNotFoundError:
+                    return # already gone again, a DELETE will follow
+                logger.debug('ADDED: %s:%s %s' % (self.storage.name, self.path(), event.name))
+                sm.event('OBJECT_ADDED', handle)
+            else:
+                child.invalidate()
+                if event.mask & flags.MOVED_TO:
+                    sm.event('OBJECT_INFO_CHANGED', child.handle)
+
+        elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+            if child is not None:
+                logger.debug('REMOVED: %s:%s %s' % (self.storage.name, self.path(), event.name))
+                handle = child.handle
+                child.unwatch()
+                child.forget()
+                sm.event('OBJECT_REMOVED', handle)
+
+        elif child is not None:
+            child.invalidate()
+            # MODIFY comes for every write, so wait for CLOSE_WRITE.
+            if event.mask & (flags.ATTRIB | flags.CLOSE_WRITE):
+                sm.event('OBJECT_INFO_CHANGED', child.handle)
+
+    def move(self, name, dest, newname):
+        """Move a child to dest keeping the handles of its whole subtree.
+
+        The fds and watches of directories below it refer to inodes, so
+        they stay valid too. Returns False if the child is not known
+        here, which is the case for renames the responder did itself.
+        """
+        child = self.children.get(name)
+        if child is None or dest.storage is not self.storage:
+            return False
+        logger.debug('MOVED: %s:%s %s -> %s %s' % (self.storage.name, self.path(), name, dest.path(), newname))
+        sm = self.storage.sm
+        target = dest.children.get(newname)
+        if target is not None:
+            handle = target.handle
+            target.unwatch()
+            target.forget()
+            sm.event('OBJECT_REMOVED', handle)
+        del self.children[name]
+        child.name = newname
+        child.parent = dest
+        dest.children[newname] = child
+        child.invalidate()
+        self.invalidate()
+        dest.invalidate()
+        self.storage.path_epoch += 1
+        if self.storage.index is not None:
+            self.storage.index.move(self.storage.key, self.handle_as_parent(), child.handle, dest.handle_as_parent(), newname)
+        sm.event('OBJECT_INFO_CHANGED', child.handle)
+        return True
 
     def handles(self, recurse=False):
+        self.load()
         if recurse:
             return itertools.chain(self.handles(False), *(c.handles(True) for c in self.children.values() if isinstance(c, FSDirObject)))
         else:
@@ -162,15 +482,20 @@ class FSDirObject(FSObject):
         logger.debug('Verifying: %s' % (self.path()))
         assert(self.path().exists())
         assert(self.path().is_dir())
-        assert(hasattr(self, 'wd'))
-        assert(self.storage.wm.watches[self.wd] == self)
+        if self.children is None:
+            assert(not hasattr(self, 'wd'))
+            return
+        if self in self.storage.wm.polled:
+            assert(not hasattr(self, 'wd'))
+        else:
+            assert(self.storage.wm.watches[self.wd] == self)
 
         for n,c in self.children.items():
             c.verify()
             assert(c.name == n)
             assert(c.parent == self)
             assert(hasattr(c, 'handle'))
-            assert(self.storage.hm.objects[c.handle] == c)
+            assert(self.storage.hm.get(c.handle) is c)
 
         for p in self.path().iterdir():
             assert(p.name in self.children)
@@ -183,11 +508,18 @@ class FSRootObject(FSDirObject):
     def __init__(self, path, storage):
         self.storage = storage
         self._path = pathlib.Path(path)
-        super().__init__(self._path, None, self.storage)
+        super().__init__(self._path.name, None, self.storage)
+        self.load()
 
     def path(self):
         return self._path
 
+    def fd(self):
+        fd = self.storage.dirfds.get(self)
+        if fd is None:
+            fd = self.storage.dirfds.put(self, os.open(str(self._path), DIR_FLAGS))
+        return fd
+
     def delete(self):
         logger.error('Cannot delete the storage root.')
         return
@@ -201,6 +533,7 @@ class FSRootObject(FSDirObject):
             logger.warning('Cache verification started')
             self.verify()
             logger.warning('Cache verification finished')
+            logger.warning(self.storage.cache_stats())
         else:
             super().inotify(event)
 
@@ -1,13 +1,32 @@
+import struct
 import asyncio
 
+import logging
+logger = logging.getLogger(__name__)
+
 import functionfs
 import functionfs.ch9
 
-from mtp.kaio import KAIOReader, KAIOWriter
+from mtp.kaio import KAIOReader, KAIOWriter, KAIOBulkWriter
 from mtp.responder import MTPResponder
+from mtp.packets import ResponseCode
 
 FS_BULK_MAX_PACKET_SIZE = 64
 HS_BULK_MAX_PACKET_SIZE = 512
+SS_BULK_MAX_PACKET_SIZE = 1024
+INT_MAX_PACKET_SIZE = 28
+
+# Still Image class requests on the control endpoint.
+CANCEL_REQUEST = 0x64
+DEVICE_RESET = 0x66
+GET_DEVICE_STATUS = 0x67
+CANCEL_TRANSACTION = 0x4001
+
+SPEEDS = {
+    FS_BULK_MAX_PACKET_SIZE: 'full',
+    HS_BULK_MAX_PACKET_SIZE: 'high',
+    SS_BULK_MAX_PACKET_SIZE: 'super',
+}
 
 class MTPFunction(functionfs.Function):
     def __init__(self, path, args):
@@ -65,13 +84,44 @@ class MTPFunction(functionfs.Function):
             functionfs.USBEndpointDescriptorNoAudio,
             bEndpointAddress=2|functionfs.ch9.USB_DIR_IN,
             bmAttributes=functionfs.ch9.USB_ENDPOINT_XFER_INT,
-            wMaxPacketSize=28,
+            wMaxPacketSize=INT_MAX_PACKET_SIZE,
             bInterval=6,
         )
 
         hs_list.append(INT_DESCRIPTOR)
         fs_list.append(INT_DESCRIPTOR)
 
+        # SuperSpeed endpoints each need a companion descriptor. The kernel
+        # uses these for SuperSpeedPlus too.
+        ss_list = [INTERFACE_DESCRIPTOR]
+        for address in (1|functionfs.ch9.USB_DIR_IN, 2|functionfs.ch9.USB_DIR_OUT):
+            ss_list.append(
+                functionfs.getDescriptor(
+                    functionfs.USBEndpointDescriptorNoAudio,
+                    bEndpointAddress=address,
+                    bmAttributes=functionfs.ch9.USB_ENDPOINT_XFER_BULK,
+                    wMaxPacketSize=SS_BULK_MAX_PACKET_SIZE,
+                    bInterval=0,
+                )
+            )
+            ss_list.append(
+                functionfs.getDescriptor(
+                    functionfs.ch9.USBSSEPCompDescriptor,
+                    bMaxBurst=args.max_burst,
+                    bmAttributes=0,
+                    wBytesPerInterval=0,
+                )
+            )
+        ss_list.append(INT_DESCRIPTOR)
+        ss_list.append(
+            functionfs.getDescriptor(
+                functionfs.ch9.USBSSEPCompDescriptor,
+                bMaxBurst=0,
+                bmAttributes=0,
+                wBytesPerInterval=INT_MAX_PACKET_SIZE,
+            )
+        )
+
         self.loop = asyncio.get_event_loop()
         self.loop.set_exception_handler(self.exception)
 
@@ -83,6 +133,7 @@ class MTPFunction(functionfs.Function):
                 path,
                 fs_list=fs_list,
                 hs_list=hs_list,
+                ss_list=ss_list,
                 lang_dict={
                     0x0409: [
                         u'MTP',
@@ -94,12 +145,17 @@ class MTPFunction(functionfs.Function):
 
             assert len(self._ep_list) == 4
 
-            self.inep = self._ep_list[1]
-            self.outep = KAIOReader(self._ep_list[2])
+            self.inep = KAIOBulkWriter(self._ep_list[1], args.aio_writes, args.aio_write_size)
+            self.outep = KAIOReader(self._ep_list[2], args.aio_reads, args.aio_read_size)
             self.intep = KAIOWriter(self._ep_list[3])
 
-            self.outep.maxpkt = 512
-            self.inep.maxpkt = 512
+            # Until the host enables the function we don't know the speed.
+            self.outep.maxpkt = HS_BULK_MAX_PACKET_SIZE
+            self.inep.maxpkt = HS_BULK_MAX_PACKET_SIZE
+            self.inep.zerocopy = args.zerocopy
+            self.outep.writebehind = args.write_behind
+            if args.read_ahead_depth > 0:
+                self.inep.readahead = (args.read_ahead_size, args.read_ahead_depth)
 
             self.responder = MTPResponder(
                 outep=self.outep,
@@ -115,11 +171,63 @@ class MTPFunction(functionfs.Function):
             self.close()
             raise
 
+    def onEnable(self):
+        """Set up transfer framing for the speed the host connected at.
+
+        The endpoint descriptor the kernel reports is the one for the
+        negotiated speed, so its max packet size decides where short
+        packets and ZLPs go.
+        """
+        super().onEnable()
+        maxpkt = self._ep_list[1].getDescriptor().wMaxPacketSize
+        logger.info('Enabled at %s speed, bulk max packet size %d.' % (SPEEDS.get(maxpkt, 'unknown'), maxpkt))
+        for ep in (self.inep, self.outep):
+            if ep.bufsize % maxpkt:
+                logger.warning('Endpoint request size %d is not a multiple of %d.' % (ep.bufsize, maxpkt))
+            ep.maxpkt = maxpkt
+
+    def onSetup(self, request_type, request, value, index, length):
+        ch9 = functionfs.ch9
+        if (request_type & ch9.USB_TYPE_MASK) == ch9.USB_TYPE_CLASS and (request_type & ch9.USB_RECIP_MASK) == ch9.USB_RECIP_INTERFACE:
+            is_in = (request_type & ch9.USB_DIR_IN) == ch9.USB_DIR_IN
+            if request == CANCEL_REQUEST and not is_in and length == 6:
+                code, tx_id = struct.unpack('<HI', self.ep0.read(6))
+                if code == CANCEL_TRANSACTION:
+                    logger.warning('Cancel request for transaction %d.' % (tx_id, ))
+                    self.responder.cancel(tx_id)
+                else:
+                    logger.warning('Unknown cancellation code %s.' % (hex(code), ))
+                return
+            elif request == DEVICE_RESET and not is_in and length == 0:
+                self.ep0.read(0)
+                self.responder.reset()
+                for ep in self._ep_list[1:]:
+                    if ep.isHalted():
+                        ep.clearHalt()
+                return
+            elif request == GET_DEVICE_STATUS and is_in:
+                self.ep0.write(self.device_status()[:length])
+                return
+        super().onSetup(request_type, request, value, index, length)
+
+    def device_status(self):
+        """Build the Get Device Status response.
+
+        Halted bulk endpoints are listed so the initiator knows to clear
+        them, and mean the last transaction was cancelled by the device.
+        """
+        halted = [ep.getRealEndpointNumber() for ep in self._ep_list[1:3] if ep.isHalted()]
+        code = self.responder.status()
+        if halted and code == 'OK':
+            code = 'TRANSACTION_CANCELLED'
+        return struct.pack('<HH%dI' % (len(halted), ), 4 + 4 * len(halted), ResponseCode.encmapping[code], *halted)
+
     def exception(self, loop, context):
         loop.stop()
         raise context['exception']
 
     def close(self):
+        self.inep.close()
         self.outep.close()
         self.intep.close()
         super().close()
@@ -1,4 +1,5 @@
-import itertools
+import array
+import collections
 
 import logging
 logger = logging.getLogger(__name__)
@@ -6,49 +7,158 @@ logger = logging.getLogger(__name__)
 from mtp.exceptions import MTPError
 
 
+# A handle is a slot index in the low bits and the generation of the
+# slot in the high bits. Every time a slot is freed its generation is
+# bumped, so a stale handle held by the inquirer does not resolve to
+# whatever object reuses the slot. Index 0 is never used, so handle 0
+# is never given out, and the last index is skipped so that 0xffffffff
+# isn't either.
+INDEX_BITS = 24
+INDEX_MASK = (1 << INDEX_BITS) - 1
+MAX_INDEX = INDEX_MASK - 1
+
+# Placeholder for slots given out by reserve_handle().
+RESERVED = object()
+
+
 class HandleManager(object):
 
-    def __init__(self):
-        self.counter = itertools.count(1)
-        self.objects = {}
+    """Table of objects indexed by handle.
+
+    Objects live in a list indexed by slot, with the slot generations
+    in a byte array alongside, so a lookup is two index operations.
+    Freed slots go to the back of a queue and are only taken from the
+    front once more than quarantine slots are waiting, so a handle is
+    not reused until many other objects have been removed.
+
+    first is the first slot which has never been used. Handles below it
+    may only be registered explicitly, eg from a persistent index.
+
+    A slot can also be claimed by an owner which keeps its objects in
+    some other form. Looking up such a handle returns owner.view(handle).
+    """
+
+    def __init__(self, first=1, quarantine=4096):
+        self.objects = [None] * first
+        self.generations = array.array('B', bytes(first))
+        self.free = collections.deque()
+        self.quarantine = quarantine
+        self.loaders = []
+        self.owners = set()
+
+    def allocate(self):
+        while len(self.free) > self.quarantine or (self.free and len(self.objects) > MAX_INDEX):
+            index = self.free.popleft()
+            if self.objects[index] is None:
+                return index
+        if len(self.objects) > MAX_INDEX:
+            raise MTPError('STORE_FULL')
+        self.objects.append(None)
+        self.generations.append(0)
+        return len(self.objects) - 1
+
+    def place(self, handle):
+        """Return the slot for a handle chosen by the caller."""
+        index = handle & INDEX_MASK
+        if index > MAX_INDEX or index == 0:
+            raise MTPError('INVALID_OBJECT_HANDLE')
+        if index >= len(self.objects):
+            grow = index + 1 - len(self.objects)
+            self.objects.extend([None] * grow)
+            self.generations.extend(bytes(grow))
+        elif self.objects[index] is not None and self.objects[index] is not RESERVED:
+            logger.error('Trying to register an object to an already used handle.')
+        self.generations[index] = handle >> INDEX_BITS
+        return index
 
     def register(self, obj, handle=None):
         if handle is None:
-            handle = next(self.counter)
-        elif handle in self.objects:
-            logger.error('Trying to register an object to an already used handle.')
+            index = self.allocate()
+            handle = (self.generations[index] << INDEX_BITS) | index
+        else:
+            index = self.place(handle)
         if hasattr(obj, 'handle'):
-            if obj.handle in self.objects:
+            if self.get(obj.handle) is obj:
                 logger.error('Object is already registered.')
             else:
                 logger.error('Object already has a handle but it is not known to this handle manager.')
         obj.handle = handle
-        self.objects[handle] = obj
+        self.objects[index] = obj
+        return handle
+
+    def claim(self, owner, handle=None):
+        """Allocate a handle on behalf of owner."""
+        self.owners.add(owner)
+        if handle is None:
+            index = self.allocate()
+            handle = (self.generations[index] << INDEX_BITS) | index
+        else:
+            index = self.place(handle)
+        self.objects[index] = owner
         return handle
 
+    def free_slot(self, index):
+        self.objects[index] = None
+        self.generations[index] = (self.generations[index] + 1) & 0xff
+        self.free.append(index)
+
     def unregister(self, obj):
         try:
             handle = obj.handle
-            del self.objects[handle]
         except AttributeError:
             logger.error('Object %s has no handle.' % (obj.path()))
-        except KeyError:
+            return
+        if self.get(handle) is not obj:
             logger.error('Object %s has a handle but is not known to handle manager.' % (obj.path()))
-        else:
-            del obj.handle
+            return
+        self.free_slot(handle & INDEX_MASK)
+        del obj.handle
+
+    def unclaim(self, handle):
+        self.free_slot(handle & INDEX_MASK)
 
     def reserve_handle(self):
-        return next(self.counter)
+        index = self.allocate()
+        self.objects[index] = RESERVED
+        return (self.generations[index] << INDEX_BITS) | index
+
+    def release(self, handle):
+        """Give back a reserved handle which was never registered."""
+        index = handle & INDEX_MASK
+        if index < len(self.objects) and self.objects[index] is RESERVED \
+                and self.generations[index] == handle >> INDEX_BITS:
+            self.free_slot(index)
 
     def handles(self):
-        return self.objects.keys()
+        return ((self.generations[i] << INDEX_BITS) | i
+                for i, obj in enumerate(self.objects) if obj is not None and obj is not RESERVED)
 
-    def __getitem__(self, handle):
+    def get(self, handle):
+        """Return the object with a handle, or None."""
+        index = handle & INDEX_MASK
         try:
-            return self.objects[handle]
-        except KeyError:
+            obj = self.objects[index]
+        except IndexError:
+            return None
+        if obj is RESERVED or self.generations[index] != handle >> INDEX_BITS:
+            return None
+        if obj in self.owners:
+            return obj.view(handle)
+        return obj
+
+    def __getitem__(self, handle):
+        obj = self.get(handle)
+        if obj is None:
+            # The handle may belong to a directory that has not been loaded yet.
+            for loader in self.loaders:
+                obj = loader(handle)
+                if obj is not None:
+                    return obj
             raise MTPError('INVALID_OBJECT_HANDLE')
+        return obj
 
     def verify(self):
-        for obj in self.objects.values():
-            assert(obj.path().exists())
\ No newline at end of file
+        for handle in self.handles():
+            obj = self.get(handle)
+            assert(obj.handle == handle)
+            assert(obj.path().exists())
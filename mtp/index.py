@@ -0,0 +1,124 @@
+import sqlite3
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    handle INTEGER PRIMARY KEY,
+    storage TEXT NOT NULL,
+    parent INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_parent ON objects (storage, parent);
+CREATE TABLE IF NOT EXISTS dirs (
+    storage TEXT NOT NULL,
+    handle INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    PRIMARY KEY (storage, handle)
+);
+'''
+
+SUBTREE = '''
+WITH RECURSIVE subtree(h) AS (
+    VALUES (?)
+    UNION SELECT objects.handle FROM objects, subtree
+    WHERE objects.storage = ? AND objects.parent = subtree.h
+)
+'''
+
+
+class StorageIndex(object):
+
+    """Persistent record of the object tree, so handles survive restarts.
+
+    For each object the index records its handle, parent handle, name,
+    type, inode, size and mtime. For each directory it also records the
+    mtime the directory had when it was last listed. Directories are
+    identified by the handle they have as a parent, so storage roots
+    are 0xffffffff, and every row belongs to a storage which is keyed
+    by its real path.
+
+    If a directory's mtime is unchanged its entries are taken from the
+    index without listing it. Otherwise it gets listed again, and the
+    new entries are matched to the old handles by name, or by inode if
+    they were renamed. Changes made while running do not update the
+    mtime of a directory, they just forget it so that the directory
+    is listed again on the next start up. Nothing is committed until
+    commit() is called, so a whole batch of changes costs one sync.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        logger.info('Opened index %s' % (path, ))
+
+    def max_index(self, mask):
+        """Return the highest handle slot in use, ignoring generation bits."""
+        (index, ) = self.db.execute('SELECT MAX(handle & ?) FROM objects', (mask, )).fetchone()
+        return index or 0
+
+    def children(self, storage, parent, mtime):
+        """Return (valid, rows) for a directory.
+
+        rows is a list of (handle, name, is_dir, inode). valid is True
+        if the directory has not changed since the rows were recorded.
+        """
+        row = self.db.execute('SELECT mtime FROM dirs WHERE storage = ? AND handle = ?',
+                              (storage, parent)).fetchone()
+        rows = self.db.execute('SELECT handle, name, is_dir, inode FROM objects WHERE storage = ? AND parent = ?',
+                               (storage, parent)).fetchall()
+        return (row is not None and row[0] == mtime), rows
+
+    def lookup(self, handle):
+        """Return (storage, parent) of an indexed handle, or None."""
+        return self.db.execute('SELECT storage, parent FROM objects WHERE handle = ?', (handle, )).fetchone()
+
+    def update_dir(self, storage, parent, mtime, entries, removed):
+        """Replace the recorded entries of a directory.
+
+        entries is a list of (handle, name, is_dir, inode, size, mtime).
+        removed is a list of handles which no longer exist. Their
+        subtrees are forgotten too.
+        """
+        for handle in removed:
+            self.remove(storage, handle)
+        self.db.execute('DELETE FROM objects WHERE storage = ? AND parent = ?', (storage, parent))
+        self.db.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            ((e[0], storage, parent) + tuple(e[1:]) for e in entries))
+        self.db.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (storage, parent, mtime))
+
+    def add(self, storage, parent, handle, name, is_dir, stat):
+        self.db.execute('INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (handle, storage, parent, name, is_dir, stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        self.forget_dir(storage, parent)
+
+    def rename(self, storage, parent, handle, name):
+        self.db.execute('UPDATE objects SET name = ? WHERE handle = ?', (name, handle))
+        self.forget_dir(storage, parent)
+
+    def move(self, storage, parent, handle, newparent, name):
+        self.db.execute('UPDATE objects SET parent = ?, name = ? WHERE handle = ?', (newparent, name, handle))
+        self.forget_dir(storage, parent)
+        self.forget_dir(storage, newparent)
+
+    def remove(self, storage, handle):
+        self.db.execute(SUBTREE + 'DELETE FROM dirs WHERE storage = ? AND handle IN subtree',
+                        (handle, storage, storage))
+        self.db.execute(SUBTREE + 'DELETE FROM objects WHERE storage = ? AND handle IN subtree',
+                        (handle, storage, storage))
+
+    def forget_dir(self, storage, handle):
+        self.db.execute('DELETE FROM dirs WHERE storage = ? AND handle = ?', (storage, handle))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,122 @@
+import os
+import stat
+import concurrent.futures
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def read_dir(path, want_stat):
+    """List a directory in the same form as FSDirObject.listdir()."""
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for fz in it:
+                try:
+                    if want_stat:
+                        st = fz.stat()
+                        entries.append((fz.name, stat.S_ISDIR(st.st_mode), st))
+                    else:
+                        entries.append((fz.name, fz.is_dir(), None))
+                except OSError:
+                    logger.warning('Skipping %s: can\'t stat it.' % (fz.path, ))
+    except OSError as e:
+        logger.warning('Skipping %s: %s' % (path, e))
+    return entries
+
+
+def pack(entries):
+    names = '\0'.join(e[0] for e in entries)
+    dirs = bytes(e[1] for e in entries)
+    stats = [e[2] for e in entries] if entries and entries[0][2] is not None else None
+    return (names, dirs, stats)
+
+
+def unpack(packed):
+    names, dirs, stats = packed
+    if not dirs:
+        return []
+    return list(zip(names.split('\0'), (bool(d) for d in dirs), stats or [None] * len(dirs)))
+
+
+def scan_subtree(path, want_stat):
+    """Worker: list every directory below path, depth first.
+
+    The listings come back in the order FSDirObject.load() visits the
+    directories, each packed as a string of names, a byte per entry
+    saying whether it is a directory and optionally the stat results,
+    which is much quicker to pickle than a tuple per entry.
+    """
+    result = []
+    stack = [path]
+    while stack:
+        path = stack.pop()
+        entries = read_dir(path, want_stat)
+        result.append(pack(entries))
+        stack.extend(reversed([os.path.join(path, e[0]) for e in entries if e[1]]))
+    return result
+
+
+class Subtree(object):
+
+    __slots__ = ('path', 'entries', 'children')
+
+    def __init__(self, path, want_stat):
+        self.path = path
+        self.entries = read_dir(path, want_stat)
+        self.children = {}
+
+
+class Indexer(object):
+
+    """Scan storages in a pool of worker processes.
+
+    The top levels of each storage are listed here until there are
+    enough subdirectories to keep the workers busy, then each of those
+    subtrees is scanned by a worker. scan() returns an iterator over
+    the listings of every directory in the order a serial scan would
+    visit them, so objects are created and given handles in the same
+    order no matter which worker finishes first. Results are consumed
+    as they arrive, so the first subtree is being loaded while the
+    workers are still scanning the others.
+
+    All storages should be passed to scan() before any of them are
+    consumed, so that they are scanned in parallel too.
+    """
+
+    def __init__(self, workers, depth=3):
+        self.workers = workers
+        self.depth = depth
+        self.pool = concurrent.futures.ProcessPoolExecutor(workers)
+
+    def scan(self, path, want_stat=False):
+        root = Subtree(str(path), want_stat)
+        frontier = [root]
+        for depth in range(self.depth):
+            subdirs = [(node, e[0]) for node in frontier for e in node.entries if e[1]]
+            if not subdirs or len(subdirs) >= self.workers * 4:
+                break
+            frontier = []
+            for node, name in subdirs:
+                child = Subtree(os.path.join(node.path, name), want_stat)
+                node.children[name] = child
+                frontier.append(child)
+        for node in frontier:
+            for e in node.entries:
+                if e[1]:
+                    node.children[e[0]] = self.pool.submit(scan_subtree, os.path.join(node.path, e[0]), want_stat)
+        return self.listings(root)
+
+    def listings(self, node):
+        yield node.entries
+        for e in node.entries:
+            if e[1]:
+                child = node.children[e[0]]
+                if isinstance(child, Subtree):
+                    yield from self.listings(child)
+                else:
+                    for packed in child.result():
+                        yield unpack(packed)
+
+    def close(self):
+        self.pool.shutdown()
@@ -1,22 +1,27 @@
 import os
+import errno
 import ctypes
 import struct
+import mmap
+import select
+import asyncio
+import collections
 
 import logging
 logger = logging.getLogger(__name__)
 
 from libaio import eventfd
-from libaio.libaio import io_setup, io_prep_pread, io_prep_pwrite, io_submit, io_getevents, io_destroy
+from libaio.libaio import io_setup, io_prep_pread, io_prep_pwrite, io_submit, io_getevents, io_destroy, io_cancel
 from libaio.libaio import io_context_t, iocb, io_event
 from libaio.libaio import IOCB_FLAG_RESFD
 
 class KAIOFile(object):
 
 
-    def __init__(self, file, nr_events=1):
+    def __init__(self, file, nr_events=1, evflags=0):
         self.file = file
         self.filefd = file if type(file) == int else file.fileno()
-        self.evfd = eventfd(0, 0)
+        self.evfd = eventfd(0, evflags)
         self.closed = False
         self.ctx = io_context_t()
         io_setup(nr_events, ctypes.byref(self.ctx))
@@ -34,7 +39,92 @@ class KAIOFile(object):
             self.closed = True
 
 
-class KAIOReader(KAIOFile):
+class KAIOPool(KAIOFile):
+
+    """A fixed set of buffers, each with its own iocb.
+
+    The buffers and iocbs are allocated once and reused for every
+    operation, so they stay alive for as long as the kernel might touch
+    them. The eventfd is non-blocking: use wait() to block until
+    something completes.
+    """
+
+    def __init__(self, file, nr_requests, bufsize):
+        super().__init__(file, nr_requests, os.O_NONBLOCK)
+        self.nr_requests = nr_requests
+        self.bufsize = bufsize
+        self.bufs = [ctypes.create_string_buffer(bufsize) for i in range(nr_requests)]
+        self.views = [memoryview(b).cast('B') for b in self.bufs]
+        self.iocbs = (iocb * nr_requests)()
+        self.iocbptrs = (ctypes.POINTER(iocb) * nr_requests)()
+        self.slots = {}
+        for i in range(nr_requests):
+            self.slots[ctypes.addressof(self.iocbs[i])] = i
+        self.events = (io_event * nr_requests)()
+
+    def prep(self, slot, length, prep=io_prep_pread, buf=None):
+        if buf is None:
+            buf = self.bufs[slot]
+        prep(self.iocbs[slot], self.filefd, ctypes.cast(buf, ctypes.c_void_p), length, 0)
+        self.iocbs[slot].u.c.flags |= IOCB_FLAG_RESFD
+        self.iocbs[slot].u.c.resfd = self.evfd
+
+    def submit_slots(self, slots):
+        for n, i in enumerate(slots):
+            self.iocbptrs[n] = ctypes.pointer(self.iocbs[i])
+        io_submit(self.ctx, len(slots), self.iocbptrs)
+
+    def reap(self):
+        """Return a list of (slot, result) for finished operations. Never blocks."""
+        try:
+            os.read(self.evfd, 8)
+        except BlockingIOError:
+            return []
+        ret = io_getevents(self.ctx, 0, self.nr_requests, self.events, None)
+        return [(self.slots[ctypes.cast(self.events[i].obj, ctypes.c_void_p).value], self.events[i].res) for i in range(ret)]
+
+    def cancel(self, slots):
+        """Ask the kernel to give up on operations still in flight.
+
+        Cancelled operations complete with -ECANCELED, and the ones the
+        kernel can't cancel complete as normal, so either way they must
+        still be reaped.
+        """
+        for i in slots:
+            try:
+                io_cancel(self.ctx, ctypes.pointer(self.iocbs[i]), ctypes.byref(self.events[0]))
+            except OSError as e:
+                # EINPROGRESS means the completion will come through the ring.
+                if e.errno != errno.EINPROGRESS:
+                    logger.debug('Can\'t cancel request: %s' % (e, ))
+
+    def flush_fifo(self):
+        """Discard anything the UDC still holds for the endpoint."""
+        flush = getattr(self.file, 'flushFIFO', None)
+        if flush is not None:
+            try:
+                flush()
+            except OSError as e:
+                logger.debug('Can\'t flush FIFO: %s' % (e, ))
+
+    def wait(self):
+        select.select([self.evfd], [], [])
+
+    async def wait_async(self):
+        """Like wait(), but lets the event loop run in the meantime."""
+        loop = asyncio.get_event_loop()
+        done = loop.create_future()
+        def readable():
+            if not done.done():
+                done.set_result(None)
+        loop.add_reader(self.evfd, readable)
+        try:
+            await done
+        finally:
+            loop.remove_reader(self.evfd)
+
+
+class KAIOReader(KAIOPool):
 
     """KAIOReader: Wrap a file in Linux Kernel AIO.
 
@@ -56,6 +146,15 @@ class KAIOReader(KAIOFile):
     identical to an endpoint file, except that select() and epoll()
     work on it.
 
+    KAIOReader keeps a ring of nr_requests reads of bufsize bytes each
+    in flight, so the UDC always has somewhere to put the next packet.
+    Completions are reaped in batches and returned by read() in the
+    order they were submitted. bufsize must be a multiple of the max
+    packet size. A read completes either when its buffer is full or
+    when a short packet (including a ZLP) ends the transfer, so a
+    buffer never holds data from two different transfers. A buffer
+    shorter than bufsize therefore always marks the end of a transfer.
+
     There are a few gotchas:
 
     1. KAIOReader.submit() must be called manually the first time.
@@ -64,64 +163,295 @@ class KAIOReader(KAIOFile):
        be opened before the gadget is bound, so we can't do both at
        the same time.
 
-    2. readinto() etc are not supported, only read().
+    2. readinto() etc are not supported. read() returns a copy of the
+       buffer. readview() returns a memoryview of the buffer itself,
+       which is only valid until the next read(), readview() or
+       release(). The buffer is not resubmitted until then.
+
+    3. The eventfd only tells you that completions happened, not how
+       many buffers are waiting. Use ready() to check without blocking.
     """
 
-    def __init__(self, file):
-        super().__init__(file, 1)
-        self.iocb = iocb()
-        self.buf = ctypes.c_buffer(512)
-        io_prep_pread(self.iocb, self.filefd, ctypes.cast(self.buf, ctypes.c_void_p), 512, 0)
-        self.iocb.u.c.flags |= IOCB_FLAG_RESFD
-        self.iocb.u.c.resfd = self.evfd
-        self.iocbptr = ctypes.pointer(self.iocb)
+    one = struct.pack('Q', 1)
+
+    def __init__(self, file, nr_requests=4, bufsize=0x10000):
+        super().__init__(file, nr_requests, bufsize)
+        for i in range(nr_requests):
+            self.prep(i, bufsize)
+        self.results = [None] * nr_requests
+        self.idle = list(range(nr_requests))
+        self.inflight = collections.deque()
+        self.current = None
+        self.writebehind = 0
+        self.writepool = []
 
     def submit(self):
-        io_submit(self.ctx, 1, ctypes.byref(self.iocbptr))
+        """Submit every idle buffer. Safe to call at any time."""
+        if not self.idle:
+            return
+        self.submit_slots(self.idle)
+        self.inflight.extend(self.idle)
+        self.idle.clear()
+
+    def ready(self):
+        """Return True if read() will not block."""
+        if not self.inflight:
+            return False
+        if self.results[self.inflight[0]] is None:
+            for slot, res in self.reap():
+                self.results[slot] = res
+        return self.results[self.inflight[0]] is not None
+
+    def release(self):
+        """Hand the buffer returned by readview() back to the kernel."""
+        if self.current is not None:
+            self.idle.append(self.current)
+            self.current = None
+            self.submit() # prime a new read operation
+
+    def readview(self):
+        self.release()
+        while not self.ready():
+            self.wait()
+
+        slot = self.inflight.popleft()
+        res = self.results[slot]
+        self.results[slot] = None
+        if res < 0:
+            self.idle.append(slot)
+            raise IOError(-res)
+        self.current = slot
+
+        if self.inflight and self.results[self.inflight[0]] is not None:
+            # More completions were reaped than have been returned, so
+            # make sure the eventfd stays readable for the event loop.
+            os.write(self.evfd, self.one)
+        return self.views[slot] if res == self.bufsize else self.views[slot][:res]
 
     def read(self):
-        os.read(self.evfd, 8)
-        e = io_event()
-
-        ret = io_getevents(self.ctx, 1, 1, ctypes.byref(e), None)
-        if ret != 1 :
-            raise Exception('This should never happen')
-
-        if e.res < 0:
-            raise IOError(-e.res)
-        tmp = bytearray(e.res)
-        tmp[:] = bytes(self.buf[:e.res])
-        self.submit() # prime a new read operation
+        tmp = bytearray(self.readview())
+        self.release()
         return tmp
 
+    async def abort(self):
+        """Throw away everything received and start again with empty buffers.
+
+        Used when a data stage is cancelled, so that what is left of it
+        is not mistaken for the next operation.
+        """
+        if self.current is not None:
+            self.idle.append(self.current)
+            self.current = None
+        self.cancel(self.inflight)
+        self.flush_fifo()
+        while self.inflight:
+            for slot, res in self.reap():
+                self.results[slot] = res
+            while self.inflight and self.results[self.inflight[0]] is not None:
+                slot = self.inflight.popleft()
+                self.results[slot] = None
+                self.idle.append(slot)
+            if self.inflight:
+                await self.wait_async()
+        self.submit()
+
+
+class KAIOBulkWriter(KAIOPool):
 
-class KAIOWriter(KAIOFile):
-    """Queues writes inside the kernel."""
+    """Queues bulk-IN transfers inside the kernel.
 
-    def __init__(self, file):
-        super().__init__(file, 12800)
+    Up to nr_requests writes of at most bufsize bytes are kept in flight
+    so the UDC never has to wait for Python between packets. Each
+    write() is a single transfer, exactly like writing to the endpoint
+    file: longer writes are split over several requests, which is fine
+    because bufsize is a multiple of the max packet size. Sending a ZLP
+    is up to the caller.
+
+    To avoid a copy, callers can fill a buffer returned by buffer()
+    themselves and then hand it back with submit(). sendfile() goes one
+    step further and points the requests straight at an mmap of the
+    file. write() and buffer() only block when every buffer is in
+    flight. Errors from completed writes are raised by the next call
+    which reaps them.
+    """
+
+    window = 0x1000000
+
+    def __init__(self, file, nr_requests=4, bufsize=0x10000):
+        super().__init__(file, nr_requests, bufsize)
+        self.maxpkt = 512
+        self.zerocopy = True
+        self.readahead = None
+        self.readpool = []
+        self.idle = list(range(nr_requests))
+        self.pinned = [None] * nr_requests
+        self.error = None
+        self.mapping = None
+
+    def collect(self):
+        for slot, res in self.reap():
+            self.idle.append(slot)
+            self.pinned[slot] = None
+            if res < 0 and self.error is None:
+                self.error = res
+        if self.error is not None:
+            res, self.error = self.error, None
+            raise IOError(-res)
+
+    def ready(self):
+        """Return True if buffer() and write() will not block."""
+        self.collect()
+        return bool(self.idle)
+
+    def free(self):
+        return len(self.idle)
+
+    def slot(self):
+        self.collect()
+        while not self.idle:
+            self.wait()
+            self.collect()
+        return self.idle.pop()
+
+    def buffer(self):
+        """Return (slot, memoryview) of a free buffer."""
+        slot = self.slot()
+        return slot, self.views[slot]
+
+    def submit(self, slot, length, buf=None):
+        self.prep(slot, length, io_prep_pwrite, buf)
+        try:
+            self.submit_slots((slot,))
+        except:
+            self.idle.append(slot)
+            self.pinned[slot] = None
+            raise
+
+    def sendfile(self, fd, offset, length):
+        """Queue length bytes of fd, starting at offset, without copying them.
+
+        The file is mapped a window at a time and each request points
+        into the mapping, which is kept alive until the request completes.
+        Every request is bufsize long except the last. Returns the number
+        of bytes queued, which is short if the file can't be mapped or the
+        endpoint rejects the requests. In the second case zerocopy is
+        turned off so later transfers go straight to the buffered path.
+        """
+        st = os.fstat(fd)
+        size = st.st_size
+        # The mapping is kept between calls, so a file sent a few
+        # requests at a time is not mapped again for each of them.
+        key = (st.st_dev, st.st_ino, size)
+        if self.mapping is not None and self.mapping[0] == key:
+            start, mm = self.mapping[1:]
+        else:
+            start, mm = 0, None
+        sent = 0
+        while sent < length:
+            n = min(self.bufsize, length - sent)
+            pos = offset + sent
+            if mm is None or pos < start or pos + n > start + len(mm):
+                start = pos - (pos % mmap.ALLOCATIONGRANULARITY)
+                if pos + n > size:
+                    break # the file shrank
+                try:
+                    mm = mmap.mmap(fd, min(self.window, size - start), offset=start, access=mmap.ACCESS_COPY)
+                except (ValueError, OSError) as e:
+                    logger.debug('Can\'t map file for zero copy: %s' % (e, ))
+                    mm = None
+                    break
+                self.mapping = (key, start, mm)
+                # Start reading the window in now, rather than a page
+                # at a time as the requests touch it.
+                mm.madvise(mmap.MADV_WILLNEED)
+            slot = self.slot()
+            self.pinned[slot] = (ctypes.c_char * n).from_buffer(mm, pos - start)
+            try:
+                self.submit(slot, n, self.pinned[slot])
+            except OSError as e:
+                logger.warning('Endpoint rejected zero copy write, using buffered writes: %s' % (e, ))
+                self.zerocopy = False
+                break
+            sent += n
+        return sent
+
+    def unmap(self):
+        """Let go of the mapping kept by sendfile()."""
+        self.mapping = None
 
     def write(self, buf):
-        iocb_ = iocb()
-        io_prep_pwrite(iocb_, self.filefd, ctypes.cast(buf, ctypes.c_void_p), len(buf), 0)
-        iocb_.u.c.flags |= IOCB_FLAG_RESFD
-        iocb_.u.c.resfd = self.evfd
-        iocbptr = ctypes.pointer(iocb_)
-        result = io_submit(self.ctx, 1, ctypes.byref(iocbptr))
-        logger.debug('event written')
-        # TODO: What happens when buf, iocb_, iocbptr go out of scope?
+        buf = memoryview(buf).cast('B')
+        pos = 0
+        while True:
+            slot, mv = self.buffer()
+            n = min(len(buf) - pos, self.bufsize)
+            mv[:n] = buf[pos:pos+n]
+            self.submit(slot, n)
+            pos += n
+            if pos == len(buf):
+                return pos
 
-    def pump(self):
-        res = os.read(self.evfd, 8)
-        (n_e,) = struct.unpack('Q', res)
-        e = (io_event*n_e)()
-        ret = io_getevents(self.ctx, n_e, n_e, e, None)
-        logger.debug('pumped %d of %d events' % (ret, n_e))
-        for i in range(ret):
-            logger.warning(' event %d - %d' % (i, e[i].res))
-            # TODO: Free buf, iocb_, iocbptr here?
+    def flush(self):
+        """Block until every queued write has completed."""
+        self.collect()
+        while len(self.idle) < self.nr_requests:
+            self.wait()
+            self.collect()
+
+    async def abort(self):
+        """Cancel every queued write and wait for them to come back."""
+        self.cancel([i for i in range(self.nr_requests) if i not in self.idle])
+        self.flush_fifo()
+        while True:
+            try:
+                self.collect()
+            except IOError:
+                pass # cancelled writes fail with ECANCELED
+            if len(self.idle) == self.nr_requests:
+                break
+            await self.wait_async()
+        self.unmap()
+
+
+class KAIOWriter(KAIOPool):
+
+    """Queues interrupt transfers inside the kernel.
 
+    A small pool of buffers is used, so only nr_requests events can be
+    in flight. write() never blocks: it returns False if every buffer
+    is busy, and the caller should try again after pump() has reaped
+    some completions.
+    """
+
+    def __init__(self, file, nr_requests=8, bufsize=64):
+        super().__init__(file, nr_requests, bufsize)
+        self.idle = list(range(nr_requests))
+
+    def ready(self):
+        """Return True if write() has a free buffer."""
+        return bool(self.idle)
 
+    def write(self, buf):
+        if not self.idle:
+            return False
+        slot = self.idle.pop()
+        self.views[slot][:len(buf)] = buf
+        self.prep(slot, len(buf), io_prep_pwrite)
+        try:
+            self.submit_slots((slot, ))
+        except OSError as e:
+            self.idle.append(slot)
+            logger.error('event write failed: %s' % (e, ))
+            return False
+        return True
+
+    def pump(self):
+        """Reap finished writes. Returns the number of free buffers."""
+        for slot, res in self.reap():
+            if res < 0:
+                logger.warning('event write failed: %d' % (res, ))
+            self.idle.append(slot)
+        return len(self.idle)
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import struct
 import datetime
 
 import logging
@@ -47,12 +48,98 @@ ObjectPropertyDesc = Struct(
     'type' / Switch(this.code, ObjectPropertyTypes),
     'writable' / Default(Byte, True),
     'default' / Switch(this.code, ObjectPropertyFormats),
-    'group' / Const(0, Int32ul),
+    'group' / Default(Int32ul, 0),
     'form' / Const(0, Byte),
 )
 
-def builddesc(prop):
+def builddesc(prop, writable=True, group=0):
     if ObjectPropertyFormats[prop] == MTPString:
-        return ObjectPropertyDesc.build(dict(code=prop, default=''))
+        return ObjectPropertyDesc.build(dict(code=prop, writable=writable, default='', group=group))
     else:
-        return ObjectPropertyDesc.build(dict(code=prop, default=0))
\ No newline at end of file
+        return ObjectPropertyDesc.build(dict(code=prop, writable=writable, default=0, group=group))
+
+
+# Properties we can report for filesystem objects, and the group they
+# belong to. Group 1 is what a host needs to lay out a folder, group 2
+# is what changes when a file is written.
+ObjectPropertiesSupported = [
+    'STORAGE_ID',
+    'OBJECT_FORMAT',
+    'PROTECTION_STATUS',
+    'OBJECT_SIZE',
+    'OBJECT_FILE_NAME',
+    'DATE_MODIFIED',
+    'PARENT_OBJECT',
+]
+
+ObjectPropertyGroups = {
+    'STORAGE_ID': 1,
+    'OBJECT_FORMAT': 1,
+    'PROTECTION_STATUS': 1,
+    'OBJECT_SIZE': 2,
+    'OBJECT_FILE_NAME': 1,
+    'DATE_MODIFIED': 2,
+    'PARENT_OBJECT': 1,
+}
+
+ObjectPropertiesWritable = ['OBJECT_FILE_NAME']
+
+# Datasets for GET_OBJECT_PROPS_SUPPORTED and GET_OBJECT_PROP_DESC
+# never change, so build them once.
+ObjectPropertyDescs = {
+    prop: builddesc(prop, prop in ObjectPropertiesWritable, ObjectPropertyGroups[prop]) for prop in ObjectPropertiesSupported
+}
+
+ObjectPropertiesByFormat = {
+    FormatType.encmapping[f]: ObjectPropertyCodeArray.build(ObjectPropertiesSupported)
+    for f in ('UNDEFINED', 'ASSOCIATION')
+}
+
+
+# Fast encoders for property values. These produce the same bytes as
+# ObjectPropertyFormats without going through construct.
+
+def pack_string(s):
+    if not s:
+        return b'\x00'
+    data = s.encode('utf-16-le')
+    return bytes((len(data)//2 + 1, )) + data + b'\x00\x00'
+
+ObjectPropertyPackers = {
+    'UINT16': struct.Struct('<H').pack,
+    'UINT32': struct.Struct('<I').pack,
+    'UINT64': struct.Struct('<Q').pack,
+    'STR': pack_string,
+}
+
+PropListCount = struct.Struct('<I')
+PropListHandle = struct.Struct('<I')
+
+# For each property: its name, the code and datatype part of a
+# property list element, and the value encoder.
+PropListEncoders = {
+    x[0]: (x[0], struct.pack('<HH', x[1], DataType.encmapping[x[2]]), ObjectPropertyPackers[x[2]])
+    for x in mtp.constants.object_property_codes if x[0] in ObjectPropertiesSupported
+}
+
+
+def build_prop_list(objects, props):
+    """Build an ObjectPropList dataset in one go.
+
+    objects is an iterable of (handle, values) where values maps
+    property names to values, and props is a list of property names.
+    """
+    encoders = [PropListEncoders[p] for p in props]
+    parts = [b'']
+    for handle, values in objects:
+        h = PropListHandle.pack(handle)
+        for name, codetype, pack in encoders:
+            parts.append(h)
+            parts.append(codetype)
+            parts.append(pack(values[name]))
+    parts[0] = PropListCount.pack((len(parts) - 1) // 3)
+    return b''.join(parts)
+
+
+def pack_prop_value(prop, value):
+    return PropListEncoders[prop][2](value)
@@ -1,7 +1,14 @@
+import io
+import struct
+import asyncio
+import collections
+
 from construct import *
 
 import mtp.constants
 from mtp.exceptions import MTPError
+from mtp.readahead import ReadAhead, Prefault
+from mtp.writebehind import WriteBehind
 
 
 ContainerType = Enum(Int16ul, **dict(mtp.constants.container_types))
@@ -54,40 +61,201 @@ MTPEvent = Struct(
     'p3' / Default(Int32ul, 0),
 )
 
+# Fast codec for the fixed containers. The construct definitions above
+# are the reference implementation; these must produce identical bytes.
+# Codes are plain integers here, use the Enum mappings to convert.
+
+OPERATION = ContainerType.encmapping['OPERATION']
+DATA = ContainerType.encmapping['DATA']
+RESPONSE = ContainerType.encmapping['RESPONSE']
+EVENT = ContainerType.encmapping['EVENT']
+
+OperationStruct = struct.Struct('<IHHI5I')
+ResponseStruct = OperationStruct
+DataStruct = struct.Struct('<IHHI')
+EventStruct = struct.Struct('<IHHI3I')
+
+Operation = collections.namedtuple('Operation', 'length type code tx_id p1 p2 p3 p4 p5')
+Data = collections.namedtuple('Data', 'length type code tx_id')
+
+
+def parse_operation(buf):
+    # Operations don't have to include unused parameters.
+    if len(buf) < OperationStruct.size:
+        buf = bytes(buf) + bytes(OperationStruct.size - len(buf))
+    p = Operation._make(OperationStruct.unpack_from(buf))
+    if p.type != OPERATION:
+        raise ValueError('Container type %d is not an operation.' % p.type)
+    return p
+
+
+def build_response(code, tx_id, p1=0, p2=0, p3=0, p4=0, p5=0):
+    return ResponseStruct.pack(ResponseStruct.size, RESPONSE, code, tx_id, p1, p2, p3, p4, p5)
+
+
+def build_event(code, tx_id=0, p1=0, p2=0, p3=0):
+    return EventStruct.pack(EventStruct.size, EVENT, code, tx_id, p1, p2, p3)
+
+
+def parse_data(buf):
+    p = Data._make(DataStruct.unpack_from(buf))
+    if p.type != DATA:
+        raise MTPError('INVALID_DATASET')
+    return p
+
+
 # functions for dealing with data stage packets.
 
-def indata(inep, code, tx_id, f):
+def fill(f, buf):
+    """Read from f until buf is full or EOF is reached."""
+    n = 0
+    while n < len(buf):
+        got = f.readinto(buf[n:])
+        if not got:
+            break
+        n += got
+    return n
+
+
+async def indata(inep, code, tx_id, f):
+    # The endpoint is only used when it has a free buffer, so waiting for
+    # the host lets the event loop run instead of blocking it.
     f.seek(0, 2)  # move the cursor to the end of the file
     length = f.tell()
     f.seek(0, 0)  # move back to the beginning
-    mtpdata = MTPData.build(dict(length=length + 12, code=code, tx_id=tx_id))
-    inep.write(mtpdata)
-    if length == 0:
-        return
-    while length >= inep.maxpkt:  # TODO: this should be connection max packet size rather than 512
-        inep.write(f.read(inep.maxpkt))
-        length -= inep.maxpkt
-    if length >= 0:  # geq because we need to send null sentinal packet iff len(data) is a multiple of 512
-        inep.write(f.read(length))
-
-
-def outdata(outep, code, tx_id, f):
-    buf = outep.read()
-    mtpdata = MTPData.parse(buf)
-    length = mtpdata.length - 12
-    if length == 0:
-        return
-    while length >= outep.maxpkt:  # TODO: this should be connection max packet size rather than 512
-        buf = outep.read()
-        f.write(buf)
-        if len(buf) != outep.maxpkt:
+    ra = None
+    if inep.readahead and length > inep.bufsize:
+        try:
+            fd = f.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            pass
+        else:
+            # Zero copy reads the file through a mapping instead, so
+            # only make sure it is cached before the requests touch it.
+            if inep.zerocopy:
+                ra = Prefault(fd, getattr(f, 'offset', 0), length, inep.readpool, *inep.readahead)
+            else:
+                ra = ReadAhead(f, length, inep.readpool, *inep.readahead)
+    try:
+        await send(inep, code, tx_id, f, length, ra)
+    finally:
+        if ra is not None:
+            ra.close()
+
+
+async def send(inep, code, tx_id, f, length, ra):
+    # PartialFile starts part way into the underlying file.
+    offset = getattr(f, 'offset', 0)
+
+    async def read(buf):
+        if isinstance(ra, ReadAhead):
+            return await ra.readinto(buf)
+        if ra is not None:
+            await ra.wait(offset + f.tell() + len(buf))
+        return fill(f, buf)
+
+    # The header goes in the same transfer as the start of the data.
+    while not inep.ready():
+        await inep.wait_async()
+    slot, buf = inep.buffer()
+    DataStruct.pack_into(buf, 0, length + 12, DATA, code, tx_id)
+    n = 12 + await read(buf[12:12+min(len(buf)-12, length)])
+    inep.submit(slot, n)
+    sent = n - 12
+    if n == inep.bufsize and sent < length and inep.zerocopy:
+        try:
+            fd = f.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            pass
+        else:
+            while sent < length and inep.zerocopy:
+                while not inep.ready():
+                    await inep.wait_async()
+                want = min(length - sent, inep.free() * inep.bufsize)
+                if ra is not None:
+                    await ra.wait(offset + sent + want)
+                count = inep.sendfile(fd, offset + sent, want)
+                if count:
+                    sent += count
+                    n = count % inep.bufsize or inep.bufsize
+                if count < want:
+                    break
+            inep.unmap()
+            f.seek(sent, 0)
+    while n == inep.bufsize and sent < length:
+        while not inep.ready():
+            await inep.wait_async()
+        slot, buf = inep.buffer()
+        n = await read(buf[:min(len(buf), length - sent)])
+        inep.submit(slot, n)
+        sent += n
+    # Every request but the last was full, so the transfer still needs
+    # to be ended with a ZLP if the last one was a whole number of packets.
+    if n > 0 and n % inep.maxpkt == 0:
+        while not inep.ready():
+            await inep.wait_async()
+        inep.write(b'')
+
+
+async def outdata(outep, code, tx_id, f):
+    wb = None
+    if outep.writebehind:
+        try:
+            f.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            pass
+        else:
+            wb = WriteBehind(f, outep.writepool, outep.writebehind, outep.bufsize)
+    try:
+        await receive(outep, code, tx_id, f, wb)
+    except asyncio.CancelledError:
+        if wb is not None:
+            wb.abort()
+        raise
+    finally:
+        if wb is not None:
+            await wb.close()
+
+
+async def receive(outep, code, tx_id, f, wb):
+    async def write(buf):
+        if wb is not None:
+            await wb.write(buf)
+        else:
+            f.write(buf)
+
+    # Each read returns a whole buffer, or the tail of a transfer if the
+    # buffer was not filled. Only a buffer shorter than outep.bufsize
+    # can end a transfer; if the data ends exactly on a buffer boundary
+    # the ZLP arrives as an empty buffer. The buffers belong to outep
+    # and are written out directly, without copying them, unless they
+    # are queued for a WriteBehind.
+    outep.release()
+    while not outep.ready():
+        await outep.wait_async()
+    buf = outep.readview()
+    mtpdata = parse_data(buf)
+    length = mtpdata.length - len(buf)
+    if length < 0:
+        raise MTPError('INCOMPLETE_TRANSFER')
+    await write(buf[12:])
+    if len(buf) == 12 and length > 0:
+        short = False # header was sent in a transfer of its own
+    else:
+        short = len(buf) < outep.bufsize
+    while length > 0 or not short:
+        if short:
             raise MTPError('INCOMPLETE_TRANSFER')
-        length -= outep.maxpkt
-    if length >= 0:  # geq because we need to send null sentinal packet iff len(data) is a multiple of 512
-        buf = outep.read()
-        if len(buf) != length:
+        outep.release()
+        while not outep.ready():
+            await outep.wait_async()
+        buf = outep.readview()
+        if len(buf) > length:
             raise MTPError('INCOMPLETE_TRANSFER')
-        f.write(buf)
+        await write(buf)
+        length -= len(buf)
+        short = len(buf) < outep.bufsize
+    outep.release()
     if mtpdata.code != code:
         raise MTPError('INVALID_DATASET')
     if mtpdata.tx_id != tx_id:
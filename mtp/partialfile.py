@@ -1,19 +1,30 @@
+import os
+
+
 class PartialFile(object):
 
     def __init__(self, file, offset, length):
         self.file = file
         self.file.seek(offset, 0)
         self.offset = self.file.tell()
-        self.file.seek(self.offset+length, 0)
-        self.length = self.tell()
-        self.file.seek(self.offset, 0)
+        # Seeking past the end succeeds, so only what exists is counted.
+        self.length = min(length, max(0, os.fstat(self.file.fileno()).st_size - self.offset))
+
+    def fileno(self):
+        return self.file.fileno()
 
     def read(self, *args):
         return self.file.read(*args)
 
+    def readinto(self, *args):
+        return self.file.readinto(*args)
+
     def write(self, *args):
         return self.file.write(*args)
 
+    def flush(self):
+        return self.file.flush()
+
     def seek(self, offset, whence):
         if offset > self.length:
             offset = self.length
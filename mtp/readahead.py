@@ -0,0 +1,217 @@
+import os
+import queue
+import asyncio
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ReadAhead(object):
+
+    """Read a file ahead of the endpoint in a worker thread.
+
+    The thread fills a ring of depth buffers of size bytes in order,
+    while readinto() copies the ones already filled out to endpoint
+    buffers, so the disk and the bus are busy at the same time and the
+    event loop never waits for the disk. Reads are as big as the ring
+    buffers, which suits SD cards much better than one read per
+    endpoint buffer. The ring comes from pool, a list kept by the
+    endpoint, and goes back to it, so the buffers are only allocated
+    once. close() must be called when the transfer ends, even if it
+    ended early.
+    """
+
+    def __init__(self, f, length, pool, size=0x100000, depth=4):
+        self.f = f
+        self.length = length
+        self.loop = asyncio.get_event_loop()
+        self.pool = pool
+        self.free = queue.Queue()
+        for i in range(depth):
+            self.free.put(pool.pop() if pool else bytearray(size))
+        self.filled = asyncio.Queue()
+        self.remaining = length
+        self.buf = None
+        self.current = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        remaining = self.length
+        try:
+            while remaining > 0 and not self.stopped:
+                buf = self.free.get()
+                if buf is None:
+                    return
+                if self.stopped:
+                    self.give(buf)
+                    return
+                mv = memoryview(buf)[:min(len(buf), remaining)]
+                n = 0
+                try:
+                    while n < len(mv):
+                        got = self.f.readinto(mv[n:])
+                        if not got:
+                            break
+                        n += got
+                except OSError as e:
+                    self.give(buf)
+                    self.put(e)
+                    return
+                self.put((buf, n))
+                if n < len(mv):
+                    self.put((None, 0)) # the file shrank
+                    return
+                remaining -= n
+        finally:
+            # Buffers handed back after the last read belong to the pool.
+            while True:
+                try:
+                    buf = self.free.get_nowait()
+                except queue.Empty:
+                    break
+                if buf is not None:
+                    self.give(buf)
+
+    def put(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self.arrived, item)
+        except RuntimeError:
+            self.stopped = True # the loop has gone away
+
+    def arrived(self, item):
+        if not self.stopped:
+            self.filled.put_nowait(item)
+        elif isinstance(item, tuple) and item[0] is not None:
+            self.pool.append(item[0]) # read after close()
+
+    def give(self, buf):
+        try:
+            self.loop.call_soon_threadsafe(self.pool.append, buf)
+        except RuntimeError:
+            pass
+
+    async def readinto(self, mv):
+        """Fill mv from the file. Returns less than len(mv) only at the end."""
+        n = 0
+        while n < len(mv):
+            if not self.current:
+                if self.buf is not None:
+                    self.free.put(self.buf)
+                    self.buf = None
+                if self.remaining == 0:
+                    break
+                item = await self.filled.get()
+                if isinstance(item, Exception):
+                    raise item
+                self.buf, got = item
+                if got == 0:
+                    self.remaining = 0
+                    continue
+                self.remaining -= got
+                self.current = memoryview(self.buf)[:got]
+            k = min(len(self.current), len(mv) - n)
+            mv[n:n+k] = self.current[:k]
+            self.current = self.current[k:]
+            n += k
+        return n
+
+    def close(self):
+        self.stopped = True
+        self.current = None
+        if self.buf is not None:
+            self.pool.append(self.buf)
+            self.buf = None
+        while not self.filled.empty():
+            item = self.filled.get_nowait()
+            if isinstance(item, tuple) and item[0] is not None:
+                self.pool.append(item[0])
+        while True:
+            try:
+                buf = self.free.get_nowait()
+            except queue.Empty:
+                break
+            self.pool.append(buf)
+        self.free.put(None)
+
+
+class Prefault(object):
+
+    """Read a file into the page cache ahead of sendfile() in a worker thread.
+
+    The zero copy path points requests straight at a mapping of the
+    file, so a page which is not cached yet is read from the disk by a
+    fault in io_submit(), in the event loop. The thread reads the file
+    into a scratch buffer from pool, at most depth reads of size ahead
+    of what has been waited for, so the pages are cached by the time
+    the requests are queued. close() must be called when the transfer
+    ends, even if it ended early.
+    """
+
+    def __init__(self, fd, offset, length, pool, size=0x100000, depth=4):
+        self.fd = fd
+        self.end = offset + length
+        self.size = size
+        self.ahead = size * depth
+        self.loop = asyncio.get_event_loop()
+        self.pool = pool
+        self.buf = pool.pop() if pool else bytearray(size)
+        self.done = offset
+        self.limit = offset + self.ahead
+        self.finished = False
+        self.stopped = False
+        self.cond = threading.Condition()
+        self.advanced = asyncio.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        mv = memoryview(self.buf)
+        done = self.done
+        try:
+            while done < self.end:
+                with self.cond:
+                    while done >= self.limit and not self.stopped:
+                        self.cond.wait()
+                    if self.stopped:
+                        return
+                n = os.preadv(self.fd, [mv[:min(len(mv), self.end - done)]], done)
+                if n <= 0:
+                    return # the file shrank
+                done += n
+                self.signal(done)
+        except OSError as e:
+            logger.debug('Prefault stopped: %s' % (e, ))
+        finally:
+            self.finished = True
+            self.signal(done)
+            try:
+                self.loop.call_soon_threadsafe(self.pool.append, self.buf)
+            except RuntimeError:
+                pass
+
+    def signal(self, done):
+        try:
+            self.loop.call_soon_threadsafe(self.update, done)
+        except RuntimeError:
+            self.stopped = True # the loop has gone away
+
+    def update(self, done):
+        self.done = done
+        self.advanced.set()
+
+    async def wait(self, end):
+        """Return once the file has been read up to end, or can't be."""
+        with self.cond:
+            self.limit = end + self.ahead
+            self.cond.notify()
+        while self.done < end and not self.finished:
+            self.advanced.clear()
+            await self.advanced.wait()
+
+    def close(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
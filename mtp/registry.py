@@ -1,15 +1,17 @@
 import io
 
 from mtp.exceptions import MTPError
-from mtp.packets import indata, outdata
+from mtp.packets import indata, outdata, OperationCode
 
 class Registry(object):
     def __init__(self):
         self.operations = {}
+        self.codes = {}
 
-    def __getitem__(self, name):
+    def __getitem__(self, code):
+        """Look up a handler by integer operation code."""
         try:
-            return self.operations[name]
+            return self.codes[code]
         except KeyError:
             raise MTPError('OPERATION_NOT_SUPPORTED')
 
@@ -18,6 +20,7 @@ class Registry(object):
 
     def register(self, fn, name):
         self.operations[name] = fn
+        self.codes[OperationCode.encmapping[name]] = fn
 
     def __call__(self, fn):
         """Basic decorator for operations."""
@@ -44,18 +47,25 @@ class Registry(object):
         """Decorator for operations which receive data from the inquirer.
 
         The data stage must run even if there is an error with the operation.
+        The handler returns the destination, the response parameters and
+        the object being written, whose cached metadata is dropped once
+        the data stage is over, so it doesn't depend on inotify noticing.
         """
-        def receivefile(self, p):
+        async def receivefile(self, p):
             if self.session_id is None:
                 raise MTPError('SESSION_NOT_OPEN')
             else:
                 try:
-                    (dest, params) = fn(self, p)
+                    (dest, params, obj) = fn(self, p)
                 except MTPError as e:
-                    outdata(self.outep, p.code, p.tx_id, open('/dev/null', 'wb'))
+                    await outdata(self.outep, p.code, p.tx_id, open('/dev/null', 'wb'))
                     raise e
                 else:
-                    outdata(self.outep, p.code, p.tx_id, dest)
+                    try:
+                        await outdata(self.outep, p.code, p.tx_id, dest)
+                    finally:
+                        if obj is not None:
+                            obj.invalidate()
                     return params
 
         self.register(receivefile, fn.__name__)
@@ -67,12 +77,12 @@ class Registry(object):
         The data stage must run even if there is an error with the operation.
         """
 
-        def receivedata(self, p):
+        async def receivedata(self, p):
             if self.session_id is None:
                 raise MTPError('SESSION_NOT_OPEN')
             else:
                 bio = io.BytesIO()
-                outdata(self.outep, p.code, p.tx_id, bio)
+                await outdata(self.outep, p.code, p.tx_id, bio)
                 return fn(self, p, bytes(bio.getbuffer()))
 
         self.register(receivedata, fn.__name__)
@@ -84,17 +94,17 @@ class Registry(object):
         The data stage must run even if there is an error with the operation.
         """
 
-        def senddata(self, p):
+        async def senddata(self, p):
             if self.session_id is None:
                 raise MTPError('SESSION_NOT_OPEN')
             else:
                 try:
                     (data, params) = fn(self, p)
                 except MTPError as e:
-                    indata(self.inep, p.code, p.tx_id, io.BytesIO(b''))
+                    await indata(self.inep, p.code, p.tx_id, io.BytesIO(b''))
                     raise e
                 else:
-                    indata(self.inep, p.code, p.tx_id, data)
+                    await indata(self.inep, p.code, p.tx_id, data)
                     return params
 
         self.register(senddata, fn.__name__)
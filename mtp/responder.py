@@ -1,16 +1,30 @@
 import io
+import time
+import functools
+import asyncio
 
 import logging
 logger = logging.getLogger(__name__)
 
+from construct import ConstructError
+
 from mtp.exceptions import MTPError
 from mtp.device import DeviceInfo, DeviceProperties, DevicePropertyCode
-from mtp.packets import MTPOperation, MTPResponse, DataFormats, OperationCode, EventCode
+from mtp.packets import parse_operation, build_response, build_event, DataFormats, OperationCode, ResponseCode, EventCode
 from mtp.watchmanager import WatchManager
-from mtp.handlemanager import HandleManager
-from mtp.storage import StorageManager, FilesystemStorage
-from mtp.object import ObjectInfo, ObjectPropertyCode, ObjectPropertyCodeArray, ObjectPropertyDesc, builddesc
+from mtp.handlemanager import HandleManager, INDEX_MASK
+from mtp.index import StorageIndex
+from mtp.indexer import Indexer
+from mtp.storage import StorageManager, FilesystemStorage, CompactFilesystemStorage
+from mtp.object import ObjectInfo, ObjectPropertyCode, ObjectPropertyFormats, FormatType
+from mtp.object import ObjectPropertiesSupported, ObjectPropertiesWritable, ObjectPropertyGroups
+from mtp.object import ObjectPropertiesByFormat, ObjectPropertyDescs, build_prop_list, pack_prop_value
 from mtp.registry import Registry
+from mtp.eventqueue import EventQueue
+
+FORMAT_ASSOCIATION = FormatType.encmapping['ASSOCIATION']
+
+SEND_OBJECT = OperationCode.encmapping['SEND_OBJECT']
 
 class MTPResponder(object):
     operations = Registry()
@@ -21,7 +35,7 @@ class MTPResponder(object):
         self.intep = intep
         self.loop = loop
         self.loop.add_reader(self.outep, self.handleOneOperation)
-        self.loop.add_reader(self.intep, self.intep.pump)
+        self.loop.add_reader(self.intep, self.pump_events)
 
         self.session_id = None
         self.properties = DeviceProperties(
@@ -30,16 +44,74 @@ class MTPResponder(object):
         )
 
         self.object_info = None
-
-        self.eventqueue = []
-        self.wm = WatchManager()
-        self.hm = HandleManager()
+        self.transaction = None
+        self.operation = None
+        self.cancelled = None
+
+        self.eventqueue = EventQueue()
+        self.wm = WatchManager(args.watch_budget)
+        if args.index is not None:
+            self.index = StorageIndex(args.index)
+            self.hm = HandleManager(self.index.max_index(INDEX_MASK) + 1)
+        else:
+            self.index = None
+            self.hm = HandleManager()
         self.sm = StorageManager(self.hm)
+        self.sm.events = self.queue_event
+
+        # The indexer only helps when everything is listed up front.
+        if args.scan_workers > 1 and not (args.compact or args.lazy or self.index is not None):
+            indexer = Indexer(args.scan_workers)
+            listings = [indexer.scan(s[1], args.prestat) for s in args.storage]
+        else:
+            indexer = None
+            listings = [None] * len(args.storage)
+
+        for s, l in zip(args.storage, listings):
+            if args.compact:
+                CompactFilesystemStorage(s[0], s[1], self.sm, self.hm, self.wm)
+            else:
+                FilesystemStorage(s[0], s[1], self.sm, self.hm, self.wm, self.index, args.lazy, args.prestat, l)
 
-        for s in args.storage:
-            FilesystemStorage(s[0], s[1], self.sm, self.hm, self.wm)
+        if indexer is not None:
+            indexer.close()
 
-        self.loop.add_reader(self.wm, self.wm.dispatch)
+        for line in self.wm.summary():
+            logger.info(line)
+        self.loop.add_reader(self.wm, self.dispatch)
+        self.loop.call_later(1, self.poll)
+
+    def queue_event(self, code, p1=0):
+        # Events only mean anything to an initiator with a session open.
+        if self.session_id is not None:
+            logger.debug('Event: %s %s' % (code, hex(p1)))
+            self.eventqueue.put(code, p1)
+
+    def send_events(self):
+        # Events wait in the queue while the host isn't polling.
+        while self.eventqueue and self.intep.ready():
+            code, p1 = self.eventqueue.get()
+            self.intep.write(build_event(EventCode.encmapping[code], 0, p1))
+
+    def pump_events(self):
+        self.intep.pump()
+        self.send_events()
+
+    def dispatch(self):
+        self.wm.dispatch()
+        self.commit()
+        self.send_events()
+
+    def poll(self):
+        self.wm.poll()
+        self.commit()
+        self.send_events()
+        self.loop.call_later(1, self.poll)
+
+    def commit(self):
+        """Commit index changes in one go, rather than one per object."""
+        if self.index is not None:
+            self.index.commit()
 
     @operations.sender
     def GET_DEVICE_INFO(self, p):
@@ -70,10 +142,19 @@ class MTPResponder(object):
         logger.info('Session opened.')
         return (self.session_id,)
 
-    @operations.session
-    def CLOSE_SESSION(self, p):
+    def close_session(self):
         self.session_id = None
+        self.eventqueue.clear()
+        self.drop_object_info()
         logger.info('Session closed.')
+
+    @operations.session
+    def CLOSE_SESSION(self, p):
+        self.close_session()
+        for s in self.sm.stores.values():
+            logger.info('%s: %s' % (s.name, s.cache_stats()))
+        for line in self.wm.summary():
+            logger.info(line)
         return ()
 
     @operations.sender
@@ -91,7 +172,7 @@ class MTPResponder(object):
         if p.p2 != 0:
             raise MTPError('SPECIFICATION_BY_FORMAT_UNSUPPORTED')
         else:
-            num = len(self.sm.handles(p.p1, p.p3))
+            num = sum(1 for h in self.sm.handles(p.p1, p.p3))
         return (num, )
 
     @operations.sender
@@ -147,12 +228,12 @@ class MTPResponder(object):
         (parent, info, handle) = self.object_info
         if (info.format == 'ASSOCIATION' and info.association_type == 'GENERIC_FOLDER') or info.compressed_size == 0:
             f = open('/dev/null', 'wb')
+            obj = None
         else:
-            p = parent.path() / info.filename
-            f = p.open('wb')
-            parent.add_child(p, handle)
+            f = parent.open_child(info.filename, 'wb')
+            obj = self.hm[parent.add_child(info.filename, handle, cache=False)]
         self.object_info = None
-        return (f, ())
+        return (f, (), obj)
 
     @operations.sender
     def GET_DEVICE_PROP_DESC(self, p):
@@ -189,8 +270,9 @@ class MTPResponder(object):
 
     @operations.filereceiver
     def SEND_PARTIAL_OBJECT(self, p):
-        fp = self.hm[p.p1].partial_file(p.p2 | (p.p3 << 32), p.p4)
-        return (fp, ())
+        obj = self.hm[p.p1]
+        fp = obj.partial_file(p.p2 | (p.p3 << 32), p.p4)
+        return (fp, (), obj)
 
     @operations.session
     def TRUNCATE_OBJECT(self, p):
@@ -205,48 +287,46 @@ class MTPResponder(object):
     def END_EDIT_OBJECT(self, p):
         return ()
 
-#    @operations.sender
-#    def GET_OBJECT_PROPS_SUPPORTED(self, p):
-#        logger.warning('format {}'.format(hex(p.p1)))
-#        data = ObjectPropertyCodeArray.build(['STORAGE_ID', 'OBJECT_FORMAT', 'PROTECTION_STATUS', 'OBJECT_SIZE', 'OBJECT_FILE_NAME', 'DATE_MODIFIED', 'PARENT_OBJECT', 'NAME'])
-#        return (io.BytesIO(data), ())
+    def object_property(self, code):
+        name = ObjectPropertyCode.decmapping.get(code)
+        if name not in ObjectPropertiesSupported:
+            raise MTPError('INVALID_OBJECT_PROP_CODE')
+        return name
 
-#    @operations.sender
-#    def GET_OBJECT_PROP_DESC(self, p):
-#        data = builddesc(ObjectPropertyCode.decmapping[p.p1])
-#        return (io.BytesIO(data), ())
+    @operations.sender
+    def GET_OBJECT_PROPS_SUPPORTED(self, p):
+        try:
+            data = ObjectPropertiesByFormat[p.p1]
+        except KeyError:
+            raise MTPError('INVALID_OBJECT_FORMAT_CODE')
+        return (io.BytesIO(data), ())
 
-#    @operations.sender
-#    def GET_OBJECT_PROP_VALUE(self, p):
-#        obj = self.hm[p.p1]
-#        code = ObjectPropertyCode.decmapping[p.p2]
-#        if code == 'STORAGE_ID':
-#            data = obj.storage.id
-#        elif code == 'OBJECT_FORMAT':
-#            data = 0x3001 if obj.path().is_dir() else 0x3000
-#        elif code == 'PROTECTION_STATUS':
-#            data = 0
-#        elif code == 'OBJECT_SIZE':
-#            data = obj.path().stat().st_size
-#        elif code == 'OBJECT_FILE_NAME' or code == 'NAME':
-#            data = 'asd'
-#        elif code == 'DATE_MODIFIED':
-#            data = ''
-#        elif code == 'PARENT_OBJECT':
-#            data = obj.parent.handle
-#        else:
-#            raise MTPError(code='INVALID_OBJECT_PROP_CODE')
-#        data = ObjectPropertyFormats[code].build(data)
-#        return (io.BytesIO(data), ())
+    @operations.sender
+    def GET_OBJECT_PROP_DESC(self, p):
+        if p.p2 not in ObjectPropertiesByFormat:
+            raise MTPError('INVALID_OBJECT_FORMAT_CODE')
+        data = ObjectPropertyDescs[self.object_property(p.p1)]
+        return (io.BytesIO(data), ())
 
-#    @operations.receiver
-#    def SET_OBJECT_PROP_VALUE(self, p, value):
-#        return ()
+    @operations.sender
+    def GET_OBJECT_PROP_VALUE(self, p):
+        obj = self.hm[p.p1]
+        name = self.object_property(p.p2)
+        data = pack_prop_value(name, obj.properties()[name])
+        return (io.BytesIO(data), ())
 
-#    @operations.sender
-#    def GET_OBJECT_PROP_LIST(self, p):
-#        data = DataFormats['AUINT32'].build([])
-#        return (io.BytesIO(data), ())
+    @operations.receiver
+    def SET_OBJECT_PROP_VALUE(self, p, value):
+        obj = self.hm[p.p1]
+        name = self.object_property(p.p2)
+        if name not in ObjectPropertiesWritable:
+            raise MTPError('ACCESS_DENIED')
+        try:
+            filename = ObjectPropertyFormats[name].parse(value)
+        except ConstructError:
+            raise MTPError('INVALID_OBJECT_PROP_VALUE')
+        obj.rename(filename)
+        return ()
 
 #    @operations.sender
 #    def GET_OBJECT_REFERENCES(self, p):
@@ -256,28 +336,173 @@ class MTPResponder(object):
 #    def SET_OBJECT_REFERENCES(self, p, value):
 #        return ()
 
+    @operations.sender
+    def GET_OBJECT_PROP_LIST(self, p):
+        if p.p3 == 0xffffffff:
+            props = ObjectPropertiesSupported
+        elif p.p3 == 0:
+            props = [x for x in ObjectPropertiesSupported if p.p4 != 0 and ObjectPropertyGroups[x] == p.p4]
+            if not props:
+                raise MTPError('SPECIFICATION_BY_GROUP_UNSUPPORTED')
+        else:
+            name = ObjectPropertyCode.decmapping.get(p.p3)
+            if name not in ObjectPropertiesSupported:
+                raise MTPError('INVALID_OBJECT_PROP_CODE')
+            props = [name]
+
+        if p.p5 == 0:
+            handles = () if p.p1 == 0 else (p.p1, )
+        elif p.p5 not in (1, 0xffffffff):
+            raise MTPError('SPECIFICATION_BY_DEPTH_UNSUPPORTED')
+        elif p.p1 in (0, 0xffffffff):
+            handles = self.sm.handles(0xffffffff, 0 if p.p5 == 0xffffffff else 0xffffffff)
+        else:
+            obj = self.hm[p.p1]
+            if obj.properties()['OBJECT_FORMAT'] != FORMAT_ASSOCIATION:
+                handles = () # nothing below a file
+            else:
+                handles = obj.handles(recurse=p.p5 == 0xffffffff)
+
+        objects = ((h, self.hm[h].properties()) for h in handles)
+        if p.p2 != 0:
+            objects = (x for x in objects if x[1]['OBJECT_FORMAT'] == p.p2)
+        data = build_prop_list(objects, props)
+        return (io.BytesIO(data), ())
+
+    def drop_object_info(self):
+        if self.object_info is not None:
+            self.hm.release(self.object_info[2])
+            self.object_info = None
+
     def respond(self, code, tx_id, p1=0, p2=0, p3=0, p4=0, p5=0):
-        args = locals()
-        del args['self']
-        logger.debug(' '.join(str(x) for x in ('Response:', args['code'], hex(args['p1']), hex(args['p2']), hex(args['p3']), hex(args['p4']), hex(args['p5']))))
-        self.inep.write(MTPResponse.build(args))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(' '.join(str(x) for x in ('Response:', code, hex(p1), hex(p2), hex(p3), hex(p4), hex(p5))))
+        self.commit()
+        self.inep.write(build_response(ResponseCode.encmapping[code], tx_id, p1, p2, p3, p4, p5))
 
     def handleOneOperation(self):
+        if self.transaction is not None or not self.outep.ready():
+            return
         try:
             buf = self.outep.read()
         except IOError as e: # inquirer disconnected?
             logger.error('IOError when reading: %d' % (e.args[0]))
             self.outep.submit()
             return
-        # TODO: parser can't handle short packets without p1-p5 args, so extend buffer with zeros.
-        buf += b'\x00'*(32-len(buf))
-        p = MTPOperation.parse(buf)
-        logger.debug(' '.join(str(x) for x in ('Operation:', p.code, hex(p.p1), hex(p.p2), hex(p.p3), hex(p.p4), hex(p.p5))))
-        if p.code not in ['SEND_OBJECT']:
-            self.object_info = None
         try:
-            self.respond('OK', p.tx_id, *self.operations[p.code](self, p))
+            p = parse_operation(buf)
+        except ValueError as e:
+            logger.error('Discarding %d byte packet: %s' % (len(buf), e))
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(' '.join(str(x) for x in ('Operation:', OperationCode.decmapping.get(p.code, hex(p.code)), hex(p.p1), hex(p.p2), hex(p.p3), hex(p.p4), hex(p.p5))))
+        if p.code != SEND_OBJECT:
+            self.drop_object_info()
+        try:
+            result = self.operations[p.code](self, p)
         except MTPError as e:
-            logger.warning(' '.join(str(x) for x in ('Operation:', p.code, hex(p.p1), hex(p.p2), hex(p.p3), hex(p.p4), hex(p.p5))))
-            logger.warning(' '.join(str(x) for x in ('MTPError:', e)))
-            self.respond(e.code, p.tx_id, *e.params)
+            self.error(p, e)
+            return
+        if asyncio.iscoroutine(result):
+            # Operations with a data stage run as a task, so the event loop
+            # keeps servicing inotify, events and ep0 during the transfer.
+            # The task owns outep until it has responded.
+            self.loop.remove_reader(self.outep)
+            self.operation = p
+            self.transaction = self.loop.create_task(self.complete(p, result))
+            self.transaction.add_done_callback(functools.partial(self.finished, result))
+        else:
+            self.respond('OK', p.tx_id, *result)
+
+    async def complete(self, p, coro):
+        try:
+            response = ('OK', p.tx_id) + tuple(await coro)
+        except MTPError as e:
+            self.warn(p, e)
+            response = (e.code, p.tx_id) + tuple(e.params)
+        except Exception as e:
+            self.loop.call_exception_handler({'message': 'Transaction failed', 'exception': e})
+            return
+        # After a data stage every IN buffer can still be waiting for the
+        # host, and write() would block the event loop until one is free.
+        while not self.inep.ready():
+            await self.inep.wait_async()
+        self.respond(*response)
+
+    def finished(self, coro, task):
+        """Called when a transaction task is done, however it ended.
+
+        A cancel can arrive before the task has even started, in which
+        case none of complete() runs, so going back to idle is done here.
+        """
+        coro.close() # in case it never started
+        if self.cancelled is None:
+            self.resume()
+            return
+        # The initiator doesn't expect a response to a cancelled
+        # transaction, it polls the device status until it is idle.
+        p = self.operation
+        logger.warning(' '.join(str(x) for x in ('Operation:', OperationCode.decmapping.get(p.code, hex(p.code)), hex(p.p1), hex(p.p2), hex(p.p3), hex(p.p4), hex(p.p5))))
+        logger.warning('TRANSACTION_CANCELLED')
+        self.flush()
+
+    def flush(self):
+        self.transaction = self.loop.create_task(self.abort())
+        self.transaction.add_done_callback(self.aborted)
+
+    def aborted(self, task):
+        # abort() may have been cancelled before it could run.
+        self.cancelled = None
+        self.resume()
+
+    def resume(self):
+        self.transaction = None
+        self.operation = None
+        self.loop.add_reader(self.outep, self.handleOneOperation)
+        # The next operation may already have been reaped.
+        self.loop.call_soon(self.handleOneOperation)
+
+    async def abort(self):
+        """Throw away what is left of a cancelled data stage in both directions."""
+        try:
+            await self.inep.abort()
+            await self.outep.abort()
+        finally:
+            logger.info('Ready %.1f ms after cancel request.' % ((time.perf_counter() - self.cancelled) * 1000, ))
+            self.cancelled = None
+
+    def cancel(self, tx_id=None):
+        """Handle a Cancel Request from the initiator.
+
+        The device reports itself busy until both endpoints have been
+        cleared out, whether or not a transaction was in progress, as
+        some of the cancelled data stage may already have arrived.
+        """
+        if self.cancelled is not None:
+            return
+        self.cancelled = time.perf_counter()
+        if self.transaction is not None:
+            if tx_id is not None and tx_id != self.operation.tx_id:
+                logger.warning('Cancel request for transaction %d during %d.' % (tx_id, self.operation.tx_id))
+            self.transaction.cancel()
+        else:
+            self.loop.remove_reader(self.outep)
+            self.flush()
+
+    def reset(self):
+        """Handle a Device Reset request: cancel everything and close the session."""
+        logger.warning('Device reset by initiator.')
+        self.cancel()
+        if self.session_id is not None:
+            self.close_session()
+
+    def status(self):
+        return 'OK' if self.cancelled is None else 'DEVICE_BUSY'
+
+    def warn(self, p, e):
+        logger.warning(' '.join(str(x) for x in ('Operation:', OperationCode.decmapping.get(p.code, hex(p.code)), hex(p.p1), hex(p.p2), hex(p.p3), hex(p.p4), hex(p.p5))))
+        logger.warning(' '.join(str(x) for x in ('MTPError:', e)))
+
+    def error(self, p, e):
+        self.warn(p, e)
+        self.respond(e.code, p.tx_id, *e.params)
@@ -1,3 +1,4 @@
+import os
 import itertools
 import logging
 import shutil
@@ -11,7 +12,8 @@ IN_MASK = flags.ATTRIB | flags.CREATE | flags.DELETE | flags.MODIFY | flags.MOVE
 import mtp.constants
 from mtp.adapters import MTPString
 from mtp.exceptions import MTPError
-from mtp.filesystem import FSRootObject
+from mtp.filesystem import FSRootObject, DirFDCache
+from mtp.compact import NodeStore, FSRootNode
 
 
 StorageType = Enum(Int16ul, **dict(mtp.constants.storage_types))
@@ -36,6 +38,8 @@ class Storage(object):
     def __init__(self, name, storagemanager):
         self.name = name
         self.sm = storagemanager
+        self.info_hits = 0
+        self.info_misses = 0
         self.sm.register(self)
         logger.debug('Connect %s: %x, %s' % (type(self).__name__, self.storage_id, self.name))
 
@@ -53,6 +57,9 @@ class Storage(object):
     def handles(self, parent=0):
         return ()
 
+    def cache_stats(self):
+        return 'ObjectInfo cache: %d hits, %d misses' % (self.info_hits, self.info_misses)
+
     def __getitem__(self, item):
         raise MTPError('INVALID_OBJECT_HANDLE')
 
@@ -60,11 +67,45 @@ class Storage(object):
 
 class FilesystemStorage(Storage):
 
-    def __init__(self, friendlyname, path, storagemanager, handlemanager, watchmanager):
+    def __init__(self, friendlyname, path, storagemanager, handlemanager, watchmanager, index=None, lazy=False, prestat=False, listings=None):
         super().__init__(friendlyname, storagemanager)
         self.hm = handlemanager
         self.wm = watchmanager
+        self.index = index
+        self.lazy = lazy
+        self.prestat = prestat
+        self.key = os.path.realpath(path)
+        self.dirfds = DirFDCache()
+        self.path_epoch = 0
+        self.listings = listings
         self.root = FSRootObject(path, self)
+        self.listings = None
+        if self.index is not None:
+            self.index.commit()
+            if self.lazy:
+                self.hm.loaders.append(self.find)
+
+    def find(self, handle):
+        """Load the directories leading to an indexed handle."""
+        chain = []
+        parent = handle
+        while True:
+            row = self.index.lookup(parent)
+            if row is None or row[0] != self.key:
+                return None
+            parent = row[1]
+            if parent == 0xffffffff:
+                break
+            chain.append(parent)
+        obj = self.root
+        for parent in reversed(chain):
+            obj.load()
+            obj = self.hm.get(parent)
+            if obj is None:
+                return None
+        obj.load()
+        self.index.commit()
+        return self.hm.get(handle)
 
     def capacity(self):
         total, used, free = shutil.disk_usage(str(self.root.path()))
@@ -82,6 +123,33 @@ class FilesystemStorage(Storage):
 
 
 
+class CompactFilesystemStorage(FilesystemStorage):
+
+    """Filesystem storage which keeps its tree in a NodeStore.
+
+    Uses a fraction of the memory of FilesystemStorage for big trees,
+    but does not support the persistent index or lazy loading, and does
+    not cache ObjectInfo.
+    """
+
+    def __init__(self, friendlyname, path, storagemanager, handlemanager, watchmanager):
+        Storage.__init__(self, friendlyname, storagemanager)
+        self.hm = handlemanager
+        self.wm = watchmanager
+        self.index = None
+        self.lazy = False
+        self.prestat = False
+        self.listings = None
+        self.key = os.path.realpath(path)
+        self.dirfds = DirFDCache()
+        self.nodes = NodeStore(self, path)
+        self.root = FSRootNode(self)
+        self.nodes.scan()
+        logger.info('%s: %d objects, %d bytes of names.' % (path, len(self.nodes), len(self.nodes.names)))
+        self.nodes.watch()
+
+
+
 class StorageManager(object):
 
     def __init__(self, handlemanager):
@@ -89,6 +157,12 @@ class StorageManager(object):
         self.stores = dict()
         self.hm = handlemanager
         self.default_store = None
+        self.events = None
+
+    def event(self, code, p1=0):
+        """Pass an MTP event on to whoever is listening."""
+        if self.events is not None:
+            self.events(code, p1)
 
     def register(self, storage):
         storage_id = next(self.counter)
@@ -109,13 +183,13 @@ class StorageManager(object):
     def handles(self, storage, parent):
         if parent == 0: # all objects
             if storage == 0xffffffff: # all storage
-                return self.hm.handles()
+                return itertools.chain(*(s.handles(recurse=True) for s in self.stores.values()))
             else:
                 return self.stores[storage].handles(recurse=True)
 
         elif parent == 0xffffffff: # root objects
             if storage == 0xffffffff:
-                return itertools.chain(s.handles(recurse=False) for s in self.stores)
+                return itertools.chain(*(s.handles(recurse=False) for s in self.stores.values()))
             else:
                 return self.stores[storage].handles(recurse=False)
 
@@ -1,47 +1,141 @@
-from inotify_simple import INotify, flags
+import os
+import errno
+import collections
+
+from inotify_simple import INotify, Event, flags
 IN_MASK = flags.ATTRIB | flags.CREATE | flags.DELETE | flags.MODIFY | flags.MOVED_TO | flags.MOVED_FROM | flags.IGNORED | flags.CLOSE_WRITE
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+def max_user_watches():
+    try:
+        with open('/proc/sys/fs/inotify/max_user_watches') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return 8192
+
+
 class WatchManager(object):
 
-    def __init__(self):
+    """Watch directories for changes made on the device.
+
+    Each directory gets an inotify watch until budget watches are in
+    use, or the kernel runs out of them. Directories after that, and
+    any the kernel won't watch for another reason, are polled instead: poll() checks up to batch of them each time it is
+    called, and lists those whose mtime changed, turning the difference
+    into CREATE and DELETE events. Polled directories do not see files
+    being modified in place, only entries appearing and disappearing.
+    The default budget is half of fs.inotify.max_user_watches, leaving
+    the rest for other programs.
+    """
+
+    def __init__(self, budget=None, batch=256):
         self.inotify = INotify()
         self.watches = {}
+        self.budget = max_user_watches() // 2 if budget is None else budget
+        self.batch = batch
+        self.polled = collections.OrderedDict()
 
     def register(self, obj):
-        wd = self.inotify.add_watch(obj.path(), IN_MASK)
-        obj.wd = wd
-        self.watches[wd] = obj
+        if len(self.watches) < self.budget:
+            try:
+                wd = self.inotify.add_watch(obj.path(), IN_MASK)
+                obj.wd = wd
+                self.watches[wd] = obj
+                return
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # Deleted since it was listed, its parent will see that.
+                    logger.debug('Not watching %s: %s' % (obj.path(), e))
+                    return
+                logger.warning('Can\'t watch %s, polling it instead: %s' % (obj.path(), e))
+                if e.errno == errno.ENOSPC:
+                    # Out of watches, so poll every directory from now on.
+                    self.budget = len(self.watches)
+        self.polled[obj] = self.mtime(obj)
+
+    def mtime(self, obj):
+        try:
+            return os.stat(obj.fd()).st_mtime_ns
+        except OSError:
+            return None
 
     def unregister(self, obj):
         logger.debug('Unwatching %s.' % (obj.path()))
+        if obj in self.polled:
+            del self.polled[obj]
+            return
+        wd = getattr(obj, 'wd', None)
+        if wd is None:
+            # The watch was dropped by the kernel when the directory was deleted.
+            return
         try:
-            del self.watches[obj.wd]
-            self.inotify.rm_watch(obj.wd)
-        except AttributeError:
-            logger.error('Object %s has no watch descriptor.' % (obj.path()))
+            del self.watches[wd]
+            del obj.wd
+            self.inotify.rm_watch(wd)
         except KeyError:
             logger.error('Object %s has a watch descriptor but is not known to watch manager.' % (obj.path()))
+        except OSError as e:
+            logger.debug('Watch on %s already gone: %s' % (obj.path(), e))
 
     def fileno(self):
         return self.inotify.fd
 
     def dispatch(self):
-        for event in self.inotify.read(read_delay=1000):
+        events = self.inotify.read(read_delay=1000)
+        # A rename within the watched tree is a MOVED_FROM and a MOVED_TO
+        # with the same cookie, which arrive together.
+        moves = {e.cookie: e for e in events if e.mask & flags.MOVED_TO and e.wd in self.watches}
+        paired = set()
+        for event in events:
             if event.mask & flags.IGNORED:
                 if event.wd in self.watches:
                     del self.watches[event.wd].wd
                     del self.watches[event.wd]
                 else:
-                    logger.warning('Received ignore event for object we were not watching: %s %s.' % (event.path, event.name))
+                    # We removed the watch ourselves.
+                    logger.debug('Received ignore event for watch %d.' % (event.wd, ))
+            elif event.wd not in self.watches:
+                logger.warning('Received event for object we were not watching: %d %s.' % (event.wd, event.name))
+            elif event.mask & flags.MOVED_FROM and event.cookie in moves:
+                to = moves[event.cookie]
+                paired.add(event.cookie)
+                src, dest = self.watches[event.wd], self.watches[to.wd]
+                if not src.move(event.name, dest, to.name):
+                    src.inotify(event)
+                    dest.inotify(to)
+            elif event.mask & flags.MOVED_TO and event.cookie in paired:
+                pass # handled with its MOVED_FROM
             else:
-                if event.wd in self.watches:
-                    self.watches[event.wd].inotify(event)
-                else:
-                    logger.warning('Received event for object we were not watching: %s %s.' % (event.path, event.name))
+                self.watches[event.wd].inotify(event)
+
+    def poll(self):
+        """Check the next batch of polled directories for changes."""
+        for i in range(min(self.batch, len(self.polled))):
+            if not self.polled:
+                break # removing a subtree can unregister the rest
+            obj, mtime = self.polled.popitem(last=False)
+            self.polled[obj] = new = self.mtime(obj)
+            if new is None or new == mtime:
+                continue
+            try:
+                names = set(os.listdir(obj.fd()))
+            except OSError:
+                continue
+            known = obj.child_names()
+            for name in sorted(names - known):
+                obj.inotify(Event(-1, flags.CREATE, 0, name))
+            for name in sorted(known - names):
+                obj.inotify(Event(-1, flags.DELETE, 0, name))
+
+    def summary(self):
+        """Describe how each monitored subtree is watched."""
+        paths = set(o.path() for o in self.polled)
+        lines = ['%d directories watched with inotify (budget %d), %d polled.' % (len(self.watches), self.budget, len(paths))]
+        lines.extend('polled: %s' % (p, ) for p in sorted(paths) if p.parent not in paths)
+        return lines
 
     def verify(self):
         for obj in self.watches.values():
@@ -0,0 +1,106 @@
+import errno
+import queue
+import asyncio
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+from mtp.exceptions import MTPError
+
+ERRORS = {
+    errno.ENOSPC: 'STORAGE_FULL',
+    errno.EDQUOT: 'STORAGE_FULL',
+    errno.EROFS: 'STORE_READ_ONLY',
+}
+
+
+class WriteBehind(object):
+
+    """Write a file from a worker thread while the data stage continues.
+
+    write() copies each chunk into a buffer and queues it for the thread
+    to write to the file, so a slow write does not hold up reading the
+    endpoint. The buffers are bufsize bytes and come from pool, a list
+    kept by the endpoint so they are reused from one transfer to the
+    next. Once limit bytes are waiting, write() waits for the thread to
+    hand a buffer back, which stops the endpoint being read and pushes
+    back on the host.
+
+    If writing fails the rest of the data is discarded, so the data
+    stage still runs to the end, and close() raises the MTPError to
+    respond with. abort() discards it too, for a cancelled transfer.
+    """
+
+    def __init__(self, f, pool, limit=0x800000, bufsize=0x10000):
+        self.f = f
+        self.pool = pool
+        self.bufsize = bufsize
+        self.count = max(1, limit // bufsize)
+        self.loop = asyncio.get_event_loop()
+        self.queue = queue.Queue()
+        self.outstanding = 0
+        self.space = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.error = None
+        self.aborted = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                buf, n = item
+                if self.error is None and not self.aborted:
+                    try:
+                        self.f.write(memoryview(buf)[:n])
+                    except Exception as e:
+                        self.error = e
+                self.loop.call_soon_threadsafe(self.written, buf)
+            if self.error is None:
+                self.f.flush()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+        finally:
+            # close() waits for this, so it must happen whatever went wrong.
+            try:
+                self.loop.call_soon_threadsafe(self.finished.set)
+            except RuntimeError:
+                pass # the loop has gone away
+
+    def written(self, buf):
+        self.pool.append(buf)
+        self.outstanding -= 1
+        self.space.set()
+
+    async def write(self, buf):
+        # The endpoint buffer is reused as soon as it is released, so the
+        # data is copied into one of ours.
+        buf = memoryview(buf)
+        while len(buf) > 0:
+            while not self.pool and self.outstanding >= self.count:
+                self.space.clear()
+                await self.space.wait()
+            if self.error is not None:
+                return
+            b = self.pool.pop() if self.pool else bytearray(self.bufsize)
+            n = min(len(buf), len(b))
+            b[:n] = buf[:n]
+            self.outstanding += 1
+            self.queue.put((b, n))
+            buf = buf[n:]
+
+    def abort(self):
+        """Drop whatever hasn't been written yet. close() won't raise."""
+        self.aborted = True
+
+    async def close(self):
+        self.queue.put(None)
+        await self.finished.wait()
+        if self.error is not None and not self.aborted:
+            logger.error('Writing received data failed: %s' % (self.error, ))
+            raise MTPError(ERRORS.get(getattr(self.error, 'errno', None), 'GENERAL_ERROR'))